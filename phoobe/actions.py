@@ -1,16 +1,26 @@
+import hashlib
 import logging
 import os
 import StringIO
 from subprocess import call
-import yaml
+import threading
+import time
 
 from attrdict import AttrDict
 from cliff.command import Command
 from cliff.lister import Lister
-import paramiko
 
+from phoobe import bundle
+from phoobe import cache
+from phoobe import capture
+from phoobe import environment
+from phoobe import executor
+from phoobe import orchestration
+from phoobe import ssh
 from phoobe import template
+from phoobe import tracing
 from phoobe import utils
+from phoobe import validation
 
 class EnvironmentNotCreatedException(Exception):
     pass
@@ -18,6 +28,100 @@ class EnvironmentNotCreatedException(Exception):
 class EnvironmentAlreadyCreatedException(Exception):
     pass
 
+class ProvisionerFailedException(Exception):
+    pass
+
+class EnableWait(object):
+
+    def add_wait_arguments(self, parser):
+        parser.add_argument('--wait', default=False, action='store_true',
+                            help='Wait until the stack action is finished')
+        parser.add_argument('--timeout', default=3600, type=int,
+                            help='Seconds to wait for the stack action')
+
+    def print_event(self, event, prefix=None):
+        line = '%s %s %s %s' % (event.event_time, event.resource_name,
+                                 event.resource_status,
+                                 event.resource_status_reason)
+        if prefix:
+            line = '%s: %s' % (prefix, line)
+        self.app.stdout.write(line + '\n')
+        self.app.stdout.flush()
+
+    def get_stack_watcher(self, stack_id, name=None):
+        name = name or self.app.environment.name
+        prefix = '[%s]' % name if name != getattr(self.app.environment, 'name', None) else None
+        return orchestration.StackWatcher(self.app.connection_heat, name, stack_id,
+                                          callback=lambda event: self.print_event(event, prefix))
+
+    def wait_for_stack(self, stack_id, action, timeout, name=None, watcher=None):
+        name = name or self.app.environment.name
+        watcher = watcher or self.get_stack_watcher(stack_id, name)
+        try:
+            status = watcher.wait(action, timeout)
+        except orchestration.StackActionFailedException as e:
+            self.log.error("stack '%s' failed: %s" % (name, e))
+            raise
+        except orchestration.StackTimeoutException:
+            self.log.error("timeout while waiting for stack '%s'" % name)
+            raise
+        self.log.info("stack '%s' reached status %s" % (name, status))
+        return status
+
+
+class EnableStacks(object):
+
+    catalog_lock = threading.Lock()
+
+    def build_template(self, environment, use_softwareconfig=False, nested=False):
+        return template.Template(environment, self.app.connection, standalone=True, use_softwareconfig=use_softwareconfig, lookup_cache=self.app.lookup_cache, template_cache=self.app.template_cache, nested=nested)
+
+    def validate_environment(self, environment):
+        # the catalog is fetched once per command, also for batches
+        with self.catalog_lock:
+            if getattr(self, 'catalog', None) is None:
+                self.catalog = validation.Catalog(self.app.connection)
+        errors = validation.validate(environment, self.catalog)
+        for error in errors:
+            self.log.error("environment '%s': %s" % (environment.name, error))
+        if errors:
+            raise validation.ValidationFailedException(
+                "environment '%s' has %d errors" % (environment.name, len(errors)))
+
+    def file_hashes(self, t):
+        """Hashes of the nested stack templates, to diff them on update."""
+        return dict((filename, cache.fingerprint(content))
+                    for filename, content in t.files.items())
+
+    def create_stack(self, environment, use_softwareconfig=False, nested=False):
+        t = self.build_template(environment, use_softwareconfig, nested)
+        fields = {
+            'stack_name': environment.name,
+            'template': t.content,
+            'files': t.files,
+        }
+        result = self.app.connection_heat.stacks.create(**fields)
+        self.app.cache[environment.name] = {
+            'id': result['stack']['id'],
+            'filename': environment.filename,
+            'name': environment.name,
+            'template': t.fingerprint,
+            'files': self.file_hashes(t),
+            # defaults of update
+            'use_softwareconfig': use_softwareconfig,
+            'nested': nested,
+        }
+        return result['stack']['id']
+
+    def delete_stack(self, name):
+        stack_id = self.app.cache[name]['id']
+        self.app.connection_heat.stacks.delete(stack_id=stack_id)
+        return stack_id
+
+    def forget_stack(self, name):
+        del self.app.cache[name]
+
+
 class GenerateTemplate(Command):
 
     connection_heat_required = False
@@ -31,15 +135,36 @@ class GenerateTemplate(Command):
         parser.add_argument('--filename', default='environment.hot.yaml')
         parser.add_argument('--standalone', default=False, action='store_true')
         parser.add_argument('--use-softwareconfig', default=False, action='store_true')
+        parser.add_argument('--nested-stacks', default=False, action='store_true',
+                            help='Split the template into nested stacks per network and instance')
+        parser.add_argument('--format', default='yaml', choices=['yaml', 'json'])
         return parser
 
     def take_action(self, parsed_args):
-        t = template.Template(self.app.environment, standalone=parsed_args.standalone, use_softwareconfig=parsed_args.use_softwareconfig)
+        t = template.Template(self.app.environment, standalone=parsed_args.standalone, use_softwareconfig=parsed_args.use_softwareconfig, template_cache=self.app.template_cache, output_format=parsed_args.format, nested=parsed_args.nested_stacks)
         with open(parsed_args.filename, 'w+') as fp:
             fp.write(t.content)
+        # the nested stack templates are referenced relative to the template
+        directory = os.path.dirname(parsed_args.filename)
+        for filename, content in sorted(t.files.items()):
+            with open(os.path.join(directory, filename), 'w+') as fp:
+                fp.write(content)
+
+
+class Validate(Command, EnableStacks):
+
+    connection_heat_required = False
+    connection_required = True
+    environment_required = True
+
+    log = logging.getLogger(__name__)
+
+    def take_action(self, parsed_args):
+        self.validate_environment(self.app.environment)
+        self.app.stdout.write("environment '%s' is valid\n" % self.app.environment.name)
 
 
-class Up(Command):
+class Up(Command, EnableStacks, EnableWait):
 
     connection_heat_required = True
     connection_required = False
@@ -50,6 +175,11 @@ class Up(Command):
     def get_parser(self, prog_name):
         parser = super(Up, self).get_parser(prog_name)
         parser.add_argument('--use-softwareconfig', default=False, action='store_true')
+        parser.add_argument('--nested-stacks', default=False, action='store_true',
+                            help='Split the template into nested stacks per network and instance')
+        parser.add_argument('--skip-validation', default=False, action='store_true',
+                            help='Do not check the environment against the cloud first')
+        self.add_wait_arguments(parser)
         return parser
 
     def take_action(self, parsed_args):
@@ -58,43 +188,131 @@ class Up(Command):
             raise EnvironmentAlreadyCreatedException()
 
         try:
-            t = template.Template(self.app.environment, self.app.connection, standalone=True, use_softwareconfig=parsed_args.use_softwareconfig)
-            fields = {
-                'stack_name': self.app.environment.name,
-                'template': t.content,
-            }
-            result = self.app.connection_heat.stacks.create(**fields)
-            self.app.cache[self.app.environment.name] = {
-                'id': result['stack']['id'],
-                'filename': self.app.environment.filename,
-                'name': self.app.environment.name
-            }
+            if not parsed_args.skip_validation:
+                self.validate_environment(self.app.environment)
+            stack_id = self.create_stack(self.app.environment, parsed_args.use_softwareconfig, parsed_args.nested_stacks)
         except template.ExternalNetworkNotFoundException as e:
             self.log.error("external network '%s' not found" % e)
+            return
         except template.ProvisionerNotDefinedException as e:
             self.log.error("provisioner '%s' not defined" % e)
+            return
+
+        if parsed_args.wait:
+            self.wait_for_stack(stack_id, 'CREATE', parsed_args.timeout)
+
+
+class Update(Command, EnableStacks, EnableWait):
+
+    connection_heat_required = True
+    connection_required = False
+    environment_required = True
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(Update, self).get_parser(prog_name)
+        # by default the stack keeps the options it was created with
+        parser.add_argument('--use-softwareconfig', dest='use_softwareconfig', default=None, action='store_true')
+        parser.add_argument('--no-use-softwareconfig', dest='use_softwareconfig', action='store_false')
+        parser.add_argument('--nested-stacks', dest='nested_stacks', default=None, action='store_true',
+                            help='Split the template into nested stacks per network and instance')
+        parser.add_argument('--no-nested-stacks', dest='nested_stacks', action='store_false',
+                            help='Use a single template')
+        parser.add_argument('--preview', default=False, action='store_true',
+                            help='Only show what Heat would change')
+        self.add_wait_arguments(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        if not self.app.environment.name in self.app.cache:
+            self.log.error("environment '%s' not created" % self.app.environment.name)
+            raise EnvironmentNotCreatedException()
+        record = self.app.cache[self.app.environment.name]
+        stack_id = record['id']
+        use_softwareconfig = parsed_args.use_softwareconfig
+        if use_softwareconfig is None:
+            use_softwareconfig = record.get('use_softwareconfig', False)
+        nested = parsed_args.nested_stacks
+        if nested is None:
+            nested = record.get('nested', False)
+
+        try:
+            t = self.build_template(self.app.environment, use_softwareconfig, nested)
+            if record.get('template') == t.fingerprint:
+                self.log.warn("environment '%s' is up to date" % self.app.environment.name)
+                return
+            content = t.content
+        except template.ExternalNetworkNotFoundException as e:
+            self.log.error("external network '%s' not found" % e)
+            return
+        except template.ProvisionerNotDefinedException as e:
+            self.log.error("provisioner '%s' not defined" % e)
+            return
+
+        deployed = self.app.connection_heat.stacks.template(stack_id)
+        files = self.file_hashes(t)
+        changes = orchestration.diff_templates(deployed, utils.load_yaml(content),
+                                               record.get('files'), files)
+        if not any(changes.values()):
+            self.log.warn("environment '%s' is up to date" % self.app.environment.name)
+            record['template'] = t.fingerprint
+            self.app.cache[self.app.environment.name] = record
+            return
+        for change, sign in (('added', '+'), ('removed', '-'), ('changed', '~')):
+            for name in changes[change]:
+                self.app.stdout.write('%s %s\n' % (sign, name))
+
+        fields = {
+            'stack_id': stack_id,
+            'template': content,
+            'files': t.files,
+        }
+        if parsed_args.preview:
+            result = self.app.connection_heat.stacks.preview_update(**fields)
+            for change, resources in sorted(result['resource_changes'].items()):
+                for resource in resources:
+                    self.app.stdout.write('%s %s\n' % (change, resource['resource_name']))
+            return
+
+        watcher = self.get_stack_watcher(stack_id)
+        if parsed_args.wait:
+            watcher.mark()
+        self.app.connection_heat.stacks.update(**fields)
+        record['use_softwareconfig'] = use_softwareconfig
+        record['nested'] = nested
+        record['files'] = files
+        # Heat already has the new template, until the update is confirmed
+        # the next update has to diff against it
+        record['template'] = None
+        self.app.cache[self.app.environment.name] = record
+        if parsed_args.wait:
+            status = self.wait_for_stack(stack_id, 'UPDATE', parsed_args.timeout, watcher=watcher)
+            if status == 'UPDATE_COMPLETE':
+                record['template'] = t.fingerprint
+                self.app.cache[self.app.environment.name] = record
 
 
 class EnableSsh(object):
 
-    def prepare_ssh_connections(self):
-        self.addresses = {}
+    def prepare_ssh_connections(self, timeout=None):
+        import paramiko
+
         stack = self.app.connection_heat.stacks.get(self.app.environment.name)
+        self.addresses = orchestration.get_addresses(stack.outputs)
         for output in stack.outputs:
-            if output['output_key'].startswith('floatingip_'):
-                self.addresses[output['output_key'][11:]] = output['output_value']
             if output['output_key'] == 'private_ssh_key':
                 self.private_ssh_key = paramiko.RSAKey.from_private_key(StringIO.StringIO(output['output_value']))
                 with open('.private_ssh_key', 'w+') as fp:
                     fp.write(output['output_value'])
                 os.chmod('.private_ssh_key', 0600)
 
+        # the pool lives on the app and is closed in clean_up
+        if not self.app.ssh_pool:
+            self.app.ssh_pool = ssh.ConnectionPool(self.private_ssh_key, timeout)
 
     def get_paramiko_connection(self, address, username):
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(address, username=username, pkey=self.private_ssh_key)
-        return ssh
+        return self.app.ssh_pool.get(address, username)
 
 
 class ListEnvironments(Lister):
@@ -114,7 +332,7 @@ class ListEnvironments(Lister):
 
         return (columns,
                 (utils.get_item_properties(AttrDict(s), columns)
-                for s in self.app.cache.values() if len(s) > 0))
+                for s in self.app.cache.values()))
 
 
 class Ssh(Command, EnableSsh):
@@ -145,11 +363,9 @@ class Ssh(Command, EnableSsh):
             self.log.error("instance '%s' not found" % instance_name)
             return
 
-        self.addresses = {}
         stack = self.app.connection_heat.stacks.get(self.app.environment.name)
+        self.addresses = orchestration.get_addresses(stack.outputs)
         for output in stack.outputs:
-            if output['output_key'].startswith('floatingip_'):
-                self.addresses[output['output_key'][11:]] = output['output_value']
             if output['output_key'] == 'private_ssh_key':
                 private_ssh_key = output['output_value']
                 with open('.private_ssh_key', 'w+') as fp:
@@ -171,14 +387,113 @@ class Provision(Command, EnableSsh):
     def get_parser(self, prog_name):
        parser = super(Provision, self).get_parser(prog_name)
        parser.add_argument('--use-softwareconfig', default=False, action='store_true')
+       parser.add_argument('--parallel', default=10, type=int,
+                           help='Number of provisioner tasks to run at the same time')
+       parser.add_argument('--wait-timeout', default=600, type=int,
+                           help='Seconds to wait until all instances are accessible by SSH')
+       parser.add_argument('--connect-timeout', default=10, type=int,
+                           help='Timeout of a single SSH connection attempt')
+       parser.add_argument('--log-dir', default=None,
+                           help='Directory for the log files of the instances')
+       parser.add_argument('--output-format', default='text', choices=['text', 'json'],
+                           help='Print the output as text or as JSON lines')
+       parser.add_argument('--force', default=False, action='store_true',
+                           help='Run provisioners again that already succeeded')
        return parser
 
+    def _wait_until_ready(self, instance_name):
+        username = self.app.environment.instances[instance_name]['username']
+        duration = ssh.wait_until_ready(self.app.ssh_pool, self.addresses[instance_name],
+                                        username, self.deadline, self.connect_timeout)
+        self.output.event(instance_name, None, 'ready', 'ready after %.1fs' % duration,
+                          duration=round(duration, 1))
+        return duration
+
+    def _run_provisioner(self, task):
+        with tracing.span('provisioner %s' % task[1], 'ssh', instance=task[0]):
+            return self._execute_provisioner(task)
+
+    def _execute_provisioner(self, task):
+        instance_name, provisioner_name = task
+        provisioner = self.app.environment.provisioners[provisioner_name]
+        if provisioner['type'] != 'shell':
+            self.log.warn("skipping provisioner '%s' of unsupported type '%s'" % (provisioner_name, provisioner['type']))
+            return 0
+        if self.use_softwareconfig:
+            # already executed by the software deployments of the stack
+            return 0
+
+        # unchanged provisioners which already succeeded on the same server
+        # are not executed again, unless one of the tasks they depend on was
+        # executed, an update may have replaced the server
+        provisioner_hash = self.hashes[provisioner_name]
+        server_id = self.servers.get(instance_name)
+        if (not self.force and server_id and self.provisioned.get(task) == (server_id, provisioner_hash) and
+                not any(dependency in self.executed for dependency in self.graph.predecessors(task))):
+            self.output.event(instance_name, provisioner_name, 'unchanged')
+            self.unchanged.add(task)
+            return 0
+        self.executed.add(task)
+        self.app.cache.unset_provisioned(self.stack_id, instance_name, provisioner_name)
+
+        self.log.info("running provisioner '%s' on instance '%s'" % (provisioner_name, instance_name))
+        username = self.app.environment.instances[instance_name]['username']
+        path = os.path.join(os.path.dirname(self.app.options.environment_file), provisioner['path'])
+        command = 'bash -s'
+        if provisioner_name in self.bundles:
+            # the script runs inside of the uploaded directory
+            command = 'cd %s && bash -s' % self.bundles[provisioner_name].remote_directory
+        start = time.time()
+        self.output.event(instance_name, provisioner_name, 'started')
+        with open(path) as fp:
+            status = self.app.ssh_pool.execute(
+                self.addresses[instance_name], username, command, stdin=fp,
+                callback=lambda line, stream='stdout': self.output.write(instance_name, provisioner_name,
+                                                                         line, stream))
+        self.output.event(instance_name, provisioner_name, 'finished', status=status,
+                          duration=round(time.time() - start, 1))
+        if status == 0:
+            self.app.cache.set_provisioned(self.stack_id, instance_name, provisioner_name,
+                                           server_id, provisioner_hash)
+        return status
+
+    def _provisioner_hash(self, provisioner_name):
+        provisioner = self.app.environment.provisioners[provisioner_name]
+        data = {'provisioner': provisioner}
+        if provisioner.get('type') == 'shell':
+            path = os.path.join(os.path.dirname(self.app.options.environment_file), provisioner['path'])
+            with open(path, 'rb') as fp:
+                data['script'] = hashlib.sha256(fp.read()).hexdigest()
+        if provisioner_name in self.bundles:
+            data['directory'] = self.bundles[provisioner_name].hash
+        return cache.fingerprint(data)
+
+    def _server_ids(self):
+        """Returns the server IDs of the instances, by their server names."""
+        name = self.app.environment.name
+        servers = {}
+        for server in self.app.connect_compute().servers(name='^%s_' % name):
+            # names of other environments may match as well, ambiguous ones are unknown
+            servers[server.name] = None if server.name in servers else server.id
+        return dict((instance_name, servers.get('%s_%s' % (name, instance_name)))
+                    for instance_name in self.app.environment.instances)
+
+    def _upload(self, target):
+        instance_name, provisioner_name = target
+        username = self.app.environment.instances[instance_name]['username']
+        b = self.bundles[provisioner_name]
+        with tracing.span('upload', 'ssh', instance=instance_name, bundle=b.hash):
+            uploaded = b.upload(self.app.ssh_pool, self.addresses[instance_name], username)
+        self.output.event(instance_name, provisioner_name, 'uploaded' if uploaded else 'present',
+                          bundle=b.hash)
+        return uploaded
+
     def take_action(self, parsed_args):
         if not self.app.environment.name in self.app.cache:
             self.log.error("environment '%s' not created" % self.app.environment.name)
             raise EnvironmentNotCreatedException()
 
-        self.prepare_ssh_connections()
+        self.prepare_ssh_connections(parsed_args.connect_timeout)
 
         # check if there are provisioners assigned/available
         if not self.app.environment.provisioners:
@@ -187,38 +502,106 @@ class Provision(Command, EnableSsh):
 
         # check if environment is up and running
 
+        log_dir = parsed_args.log_dir or os.path.join(
+            self.app.data_dir, 'logs', self.app.environment.name)
+        self.output = capture.OutputWriter(self.app.stdout, log_dir, parsed_args.output_format)
+        try:
+            self._provision(parsed_args)
+        finally:
+            self.output.close()
+
+    def _provision(self, parsed_args):
         # check if instances are accessible by SSH
-        for instance_name in self.app.environment.instances:
-            self.log.debug("checking SSH access to instances '%s'" % instance_name)
-            username = self.app.environment.instances[instance_name]['username']
-            ssh = self.get_paramiko_connection(self.addresses[instance_name], username)
-            channel = ssh.invoke_shell()
-            stdin, stdout, stderr = ssh.exec_command('hostname')
-            ssh.close()
-
-        # run provisioners
-        for provisioner_name in self.app.environment.provisioners:
-            provisioner = self.app.environment.provisioners[provisioner_name]
-            self.log.info("running provisioner '%s' of type '%s'" % (provisioner_name, provisioner['type']))
-            if provisioner['type'] == 'shell' and parsed_args.use_softwareconfig:
-                self.log.warn("skipping provisioner '%s' of type 'shell', included in stack" % provisioner_name)
-            elif provisioner['type'] == 'shell':
-                for instance_name in self.app.environment.instances:
-                    if not provisioner_name in self.app.environment.instances[instance_name]['provisioners']:
-                        next
-                    username = self.app.environment.instances[instance_name]['username']
-                    environment_path = os.path.dirname(self.app.options.environment_file)
-                    call("ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i .private_ssh_key %s@%s 'bash -s' < %s" % (username, self.addresses[instance_name], os.path.join(environment_path, provisioner['path'])), shell=True)
-                    #with open(provisioner['path']) as fp:
-                    #    ssh = self.get_paramiko_connection(self.addresses[instance_name], username)
-                    #    channel = ssh.invoke_shell()
-                    #    stdin, stdout, stderr = ssh.exec_command(fp.read())
-                    #    for line in stdout.readlines():
-                    #        self.log.info('[%s, %s]: %s' % (instance_name, provisioner_name, line.strip()))
-                    #    ssh.close()
-
-
-class Destroy(Command):
+        self.executor = executor.Executor(parsed_args.parallel)
+        self.deadline = time.time() + parsed_args.wait_timeout
+        self.connect_timeout = parsed_args.connect_timeout
+        instances = list(self.app.environment.instances)
+        not_ready = [instance_name for (instance_name, result)
+                     in executor.Executor(len(instances)).map(self._wait_until_ready, instances)
+                     if isinstance(result, Exception)]
+        if not_ready:
+            self.log.error("instances not accessible by SSH: %s" % ', '.join(not_ready))
+            raise ssh.InstanceNotReadyException(', '.join(not_ready))
+
+        # run provisioners, every task starts as soon as its dependencies succeeded
+        graph = self.app.environment.provisioning_graph
+        for instance_name, provisioner_name in graph.nodes():
+            if not provisioner_name in self.app.environment.provisioners:
+                self.log.error("provisioner '%s' not defined" % provisioner_name)
+                raise template.ProvisionerNotDefinedException(provisioner_name)
+        self.use_softwareconfig = parsed_args.use_softwareconfig
+        if self.use_softwareconfig:
+            self.log.warn("skipping provisioners of type 'shell', included in stack")
+        # pack the directories of the provisioners once and upload them to
+        # all their instances at the same time
+        self.bundles = {}
+        if not self.use_softwareconfig:
+            environment_path = os.path.dirname(self.app.options.environment_file)
+            for provisioner_name in set(p for (i, p) in graph.nodes()):
+                provisioner = self.app.environment.provisioners[provisioner_name]
+                if provisioner['type'] == 'shell' and 'directory' in provisioner:
+                    try:
+                        self.bundles[provisioner_name] = bundle.Bundle(
+                            os.path.join(environment_path, provisioner['directory']))
+                    except bundle.DirectoryNotFoundException:
+                        self.log.error("directory '%s' of provisioner '%s' not found"
+                                       % (provisioner['directory'], provisioner_name))
+                        raise
+        try:
+            self._provision_tasks(parsed_args, graph)
+        finally:
+            for b in self.bundles.values():
+                b.close()
+
+    def _provision_tasks(self, parsed_args, graph):
+        # provisioners sharing a directory upload it once per instance
+        targets = dict(((i, self.bundles[p].hash), (i, p)) for (i, p) in graph.nodes()
+                       if p in self.bundles)
+        targets = sorted(targets.values())
+        failed = [target for (target, result) in self.executor.map(self._upload, targets)
+                  if isinstance(result, Exception)]
+        if failed:
+            self.log.error("upload failed: %s" % ', '.join('%s/%s' % target for target in failed))
+            raise bundle.UploadFailedException(', '.join(i for (i, p) in failed))
+
+        self.graph = graph
+        self.force = parsed_args.force
+        self.stack_id = self.app.cache[self.app.environment.name]['id']
+        self.provisioned = self.app.cache.provisioned(self.stack_id)
+        self.servers = self._server_ids()
+        self.hashes = dict((provisioner_name, self._provisioner_hash(provisioner_name))
+                           for provisioner_name in set(p for (i, p) in graph.nodes()))
+        self.executed = set()
+        self.unchanged = set()
+        results = self.executor.run_graph(self._run_provisioner, graph,
+                                          succeeded=lambda status: status == 0)
+        summary = [(task[0], task[1], results[task]) for task in sorted(results)]
+
+        failed = [(i, p, s) for (i, p, s) in summary if s != 0]
+        for instance_name, provisioner_name, status in summary:
+            if isinstance(status, executor.DependencyFailedException):
+                result = 'skipped (%s/%s failed)' % status.args[0]
+            else:
+                result = 'ok' if status == 0 else 'failed (%s)' % status
+                if (instance_name, provisioner_name) in self.unchanged:
+                    result = 'unchanged'
+            if parsed_args.output_format == 'text':
+                self.app.stdout.write('%s %s %s\n' % (instance_name, provisioner_name, result))
+            elif isinstance(status, executor.DependencyFailedException):
+                self.output.event(instance_name, provisioner_name, 'skipped',
+                                  failed='%s/%s' % status.args[0])
+            elif isinstance(status, Exception):
+                self.output.event(instance_name, provisioner_name, 'failed', error=str(status))
+        for instance_name, provisioner_name, status in failed:
+            if not isinstance(status, executor.DependencyFailedException):
+                self.log.error("provisioner '%s' failed on instance '%s', see %s"
+                               % (provisioner_name, instance_name, self.output.log_file(instance_name)))
+        if failed:
+            self.log.error("%d of %d provisioner runs failed" % (len(failed), len(summary)))
+            raise ProvisionerFailedException(', '.join('%s/%s' % (i, p) for (i, p, s) in failed))
+
+
+class Destroy(Command, EnableStacks, EnableWait):
 
     connection_heat_required = True
     connection_required = True
@@ -226,16 +609,27 @@ class Destroy(Command):
 
     log = logging.getLogger(__name__)
 
+    def get_parser(self, prog_name):
+        parser = super(Destroy, self).get_parser(prog_name)
+        self.add_wait_arguments(parser)
+        return parser
+
     def take_action(self, parsed_args):
         if not self.app.environment.name in self.app.cache:
             self.log.error("environment '%s' not created" % self.app.environment.name)
             raise EnvironmentNotCreatedException()
         stack_id = self.app.cache[self.app.environment.name]['id']
-        self.app.connection_heat.stacks.delete(stack_id=stack_id)
 
-        # check for deletion here...
+        # events of former actions (e.g. a failed delete) must not end the wait
+        watcher = self.get_stack_watcher(stack_id)
+        if parsed_args.wait:
+            watcher.mark()
+        self.delete_stack(self.app.environment.name)
+
+        if parsed_args.wait:
+            self.wait_for_stack(stack_id, 'DELETE', parsed_args.timeout, watcher=watcher)
 
-        del self.app.cache[self.app.environment.name]
+        self.forget_stack(self.app.environment.name)
 
 
 
@@ -247,6 +641,12 @@ class Resources(Lister):
 
     log = logging.getLogger(__name__)
 
+    def get_parser(self, prog_name):
+        parser = super(Resources, self).get_parser(prog_name)
+        parser.add_argument('--nested-depth', default=0, type=int,
+                            help='Include resources of nested stacks up to this depth')
+        return parser
+
     def take_action(self, parsed_args):
         if not self.app.environment.name in self.app.cache:
             self.log.error("environment '%s' not created" % self.app.environment.name)
@@ -257,7 +657,8 @@ class Resources(Lister):
             'resource',
             'status',
         )
-        resources = self.app.connection_heat.resources.list(self.app.environment.name)
+        resources = self.app.connection_heat.resources.list(self.app.environment.name,
+                                                            nested_depth=parsed_args.nested_depth)
         result = {}
         for resource in resources:
             result[resource.resource_name] = {
@@ -273,7 +674,7 @@ class Resources(Lister):
 class Status(Lister):
 
     connection_heat_required = True
-    connection_required = True
+    connection_required = False
     environment_required = True
 
     log = logging.getLogger(__name__)
@@ -282,22 +683,57 @@ class Status(Lister):
         columns = (
             'instance',
             'status',
+            'server_status',
             'public_address',
+            'private_addresses',
         )
-        stack = self.app.connection_heat.stacks.get(self.app.environment.name)
-        resources = self.app.connection_heat.resources.list(self.app.environment.name)
+
+        # stack, resources and servers are independent, fetch them at once,
+        # servers are listed with the cached token of the orchestration client
+        heat = self.app.connection_heat
+        compute = self.app.connect_compute()
+        name = self.app.environment.name
+        stack, resources, servers = executor.Executor(3).gather(
+            lambda: heat.stacks.get(name),
+            lambda: list(heat.resources.list(name)),
+            lambda: list(compute.servers(name='^%s_' % name)))
+        servers_by_id = dict((server.id, server) for server in servers)
+        servers_by_name = dict((server.name, server) for server in servers)
+
+        def row(instance_name, status, server):
+            addresses = []
+            if server:
+                for network in (server.addresses or {}).values():
+                    addresses.extend(address['addr'] for address in network
+                                     if address.get('OS-EXT-IPS:type', 'fixed') == 'fixed')
+            return {
+                'status': status,
+                'server_status': server.status if server else '-',
+                'instance': instance_name,
+                'public_address': '-',
+                'private_addresses': ', '.join(addresses) or '-',
+            }
+
         result = {}
         for resource in resources:
             if resource.resource_type == 'OS::Nova::Server':
-                result[resource.resource_name] = {
-                    'status': resource.resource_status,
-                    'instance': resource.resource_name,
-                    'public_address': '-'
-                }
-        if stack.stack_status == 'CREATE_COMPLETE':
-            for output in stack.outputs:
-                if output['output_key'].startswith('floatingip_'):
-                    result[output['output_key'][11:]]['public_address'] = output['output_value']
+                server = servers_by_id.get(resource.physical_resource_id)
+                result[resource.resource_name] = row(resource.resource_name, resource.resource_status, server)
+            elif resource.resource_name in self.app.environment.instances:
+                # instance in its own nested stack (--nested-stacks)
+                server = servers_by_name.get('%s_%s' % (name, resource.resource_name))
+                result[resource.resource_name] = row(resource.resource_name, resource.resource_status, server)
+            elif resource.resource_name in self.app.environment.groups:
+                # servers of group members live in nested stacks, match them by name
+                for instance_name, data in self.app.environment.instances.items():
+                    if data.get('group') == resource.resource_name:
+                        server = servers_by_name.get('%s_%s' % (name, instance_name))
+                        result[instance_name] = row(instance_name, resource.resource_status, server)
+        # outputs are available after every completed action but delete
+        if stack.stack_status.endswith('_COMPLETE') and not stack.stack_status.startswith('DELETE'):
+            for instance_name, address in orchestration.get_addresses(stack.outputs).items():
+                if instance_name in result:
+                    result[instance_name]['public_address'] = address
 
         return (columns,
                 (utils.get_item_properties(AttrDict(s), columns) for s in result.values()))
@@ -345,7 +781,20 @@ class ListImages(Lister):
                 for s in data))
 
 
-class ListExternalNetworks(Lister):
+class EnableNetworks(object):
+
+    def get_networks(self, columns, external):
+        # filter on the server side and resolve all subnets with one request
+        filters = {'router:external': external}
+        networks = list(self.app.connection.network.networks(**filters))
+        if not networks:
+            return []
+        subnet_index = utils.get_subnet_index(self.app.connection)
+        return [v for s in networks
+                for v in (utils.get_item_properties(s, columns, subnet_index=subnet_index, filters=filters),) if v]
+
+
+class ListExternalNetworks(Lister, EnableNetworks):
 
     connection_heat_required = False
     connection_required = True
@@ -360,14 +809,10 @@ class ListExternalNetworks(Lister):
             'subnets',
         )
 
-        return (columns,
-                (v for s in self.app.connection.network.networks()
-                 for v in (utils.get_item_properties(s, columns,
-                 connection=self.app.connection,
-                 filters={'router:external': True}),) if v))
+        return (columns, self.get_networks(columns, True))
 
 
-class ListInternalNetworks(Lister):
+class ListInternalNetworks(Lister, EnableNetworks):
 
     connection_heat_required = False
     connection_required = True
@@ -382,5 +827,158 @@ class ListInternalNetworks(Lister):
             'subnets',
         )
 
-        return (columns,
-                (v for s in self.app.connection.network.networks() for v in (utils.get_item_properties(s, columns, connection=self.app.connection, filters={'router:external': False}),) if v))
+        return (columns, self.get_networks(columns, False))
+
+
+def parse_environment_argument(value):
+    """Splits '<name>=<environment-file>' into name and filename.
+
+    Without a name the basename of the file is used.
+    """
+
+    if '=' in value:
+        return tuple(value.split('=', 1))
+    return os.path.splitext(os.path.basename(value))[0], value
+
+
+class EnableBatch(object):
+
+    def add_batch_arguments(self, parser):
+        parser.add_argument('--parallel', default=5, type=int,
+                            help='Number of environments to process at the same time')
+
+    def cached_environments(self, names):
+        if not names:
+            names = self.app.cache.keys()
+        for name in names:
+            if not name in self.app.cache:
+                self.log.error("environment '%s' not created" % name)
+                raise EnvironmentNotCreatedException(name)
+        return sorted(names)
+
+    def run_batch(self, func, items, parallel):
+        rows = []
+        failed = 0
+        for item, result in executor.Executor(parallel).map(func, items):
+            name = item[0] if isinstance(item, tuple) else item
+            if isinstance(result, Exception):
+                failed += 1
+                self.log.error("environment '%s' failed: %s" % (name, result))
+                rows.append((name, 'FAILED', str(result)))
+            else:
+                rows.append((name, result, ''))
+        if failed:
+            self.log.error("%d of %d environments failed" % (failed, len(rows)))
+        self.failed = failed
+        return (('environment', 'status', 'reason'), rows)
+
+    def exit_code(self, result):
+        """The table is printed in any case, failed environments fail the command."""
+        return 1 if getattr(self, 'failed', 0) else result
+
+
+class BatchUp(Lister, EnableStacks, EnableWait, EnableBatch):
+
+    connection_heat_required = True
+    connection_required = False
+    environment_required = False
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(BatchUp, self).get_parser(prog_name)
+        parser.add_argument('environments', nargs='+', metavar='[<name>=]<environment-file>')
+        parser.add_argument('--use-softwareconfig', default=False, action='store_true')
+        parser.add_argument('--nested-stacks', default=False, action='store_true',
+                            help='Split the template into nested stacks per network and instance')
+        parser.add_argument('--skip-validation', default=False, action='store_true',
+                            help='Do not check the environment against the cloud first')
+        self.add_wait_arguments(parser)
+        self.add_batch_arguments(parser)
+        return parser
+
+    def run(self, parsed_args):
+        return self.exit_code(super(BatchUp, self).run(parsed_args))
+
+    def take_action(self, parsed_args):
+        items = [parse_environment_argument(value) for value in parsed_args.environments]
+        for name, filename in items:
+            if name in self.app.cache:
+                self.log.error("environment '%s' already created" % name)
+                raise EnvironmentAlreadyCreatedException(name)
+
+        def up(item):
+            name, filename = item
+            env = environment.Environment(filename, name, snapshot_dir=self.app.snapshot_dir)
+            if not parsed_args.skip_validation:
+                self.validate_environment(env)
+            stack_id = self.create_stack(env, parsed_args.use_softwareconfig,
+                                         parsed_args.nested_stacks)
+            if parsed_args.wait:
+                return self.wait_for_stack(stack_id, 'CREATE', parsed_args.timeout, name)
+            return 'CREATE_IN_PROGRESS'
+
+        return self.run_batch(up, items, parsed_args.parallel)
+
+
+class BatchDestroy(Lister, EnableStacks, EnableWait, EnableBatch):
+
+    connection_heat_required = True
+    connection_required = False
+    environment_required = False
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(BatchDestroy, self).get_parser(prog_name)
+        parser.add_argument('environments', nargs='*', metavar='<environment-name>',
+                            help='Environments to destroy (default: all)')
+        self.add_wait_arguments(parser)
+        self.add_batch_arguments(parser)
+        return parser
+
+    def run(self, parsed_args):
+        return self.exit_code(super(BatchDestroy, self).run(parsed_args))
+
+    def take_action(self, parsed_args):
+        def destroy(name):
+            stack_id = self.app.cache[name]['id']
+            watcher = self.get_stack_watcher(stack_id, name)
+            if parsed_args.wait:
+                watcher.mark()
+            self.delete_stack(name)
+            status = 'DELETE_IN_PROGRESS'
+            if parsed_args.wait:
+                status = self.wait_for_stack(stack_id, 'DELETE', parsed_args.timeout, name, watcher)
+            self.forget_stack(name)
+            return status
+
+        names = self.cached_environments(parsed_args.environments)
+        return self.run_batch(destroy, names, parsed_args.parallel)
+
+
+class BatchStatus(Lister, EnableStacks, EnableBatch):
+
+    connection_heat_required = True
+    connection_required = False
+    environment_required = False
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(BatchStatus, self).get_parser(prog_name)
+        parser.add_argument('environments', nargs='*', metavar='<environment-name>',
+                            help='Environments to show (default: all)')
+        self.add_batch_arguments(parser)
+        return parser
+
+    def run(self, parsed_args):
+        return self.exit_code(super(BatchStatus, self).run(parsed_args))
+
+    def take_action(self, parsed_args):
+        def status(name):
+            stack_id = self.app.cache[name]['id']
+            return self.app.connection_heat.stacks.get(stack_id).stack_status
+
+        names = self.cached_environments(parsed_args.environments)
+        return self.run_batch(status, names, parsed_args.parallel)
@@ -0,0 +1,115 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+import threading
+
+_remote_directory = '.phoobe/bundles'
+
+
+class UploadFailedException(Exception):
+    pass
+
+
+class DirectoryNotFoundException(Exception):
+    pass
+
+
+def _files(directory):
+    """Returns the relative paths of all files below directory, sorted."""
+    result = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in files:
+            result.append(os.path.relpath(os.path.join(root, name), directory))
+    return sorted(result)
+
+
+class Bundle(object):
+    """A directory of a provisioner, packed once as compressed tarball.
+
+    The hash covers the paths, the executable bit and the content of all
+    files, so it does not change when the directory is only touched.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, directory):
+        # os.walk ignores a missing directory, the bundle would be empty
+        if not os.path.isdir(directory):
+            raise DirectoryNotFoundException(directory)
+        self.directory = directory
+        self._files = _files(directory)
+        self._archive = None
+        self._lock = threading.Lock()
+
+        digest = hashlib.sha256()
+        for name in self._files:
+            path = os.path.join(directory, name)
+            digest.update((name if isinstance(name, bytes) else name.encode('utf-8')) + b'\0')
+            digest.update(b'x' if os.access(path, os.X_OK) else b'-')
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(65536), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+        self.hash = digest.hexdigest()
+
+    @property
+    def remote_directory(self):
+        return '%s/%s' % (_remote_directory, self.hash)
+
+    @property
+    def archive(self):
+        """Filename of the compressed tarball, created on first access."""
+
+        with self._lock:
+            if self._archive is None:
+                fd, filename = tempfile.mkstemp(prefix='phoobe-', suffix='.tar.gz')
+                os.close(fd)
+                with tarfile.open(filename, 'w:gz') as tar:
+                    for name in self._files:
+                        tar.add(os.path.join(self.directory, name), arcname=name)
+                self.log.debug("packed %d files of %s into %s (%d bytes)"
+                               % (len(self._files), self.directory, filename,
+                                  os.path.getsize(filename)))
+                self._archive = filename
+            return self._archive
+
+    def upload(self, pool, address, username):
+        """Uploads and extracts the bundle unless the target already has it.
+
+        :returns: True if the bundle was uploaded, False if it was present
+        """
+
+        remote = self.remote_directory
+        if pool.execute(address, username, 'test -f %s/.complete' % remote) == 0:
+            self.log.debug("%s already on %s, skipping upload" % (self.hash, address))
+            return False
+
+        remote_archive = '%s.tar.gz' % remote
+        if pool.execute(address, username, 'mkdir -p %s' % _remote_directory) != 0:
+            raise UploadFailedException(address)
+        pool.put(address, username, self.archive, remote_archive)
+        command = ('rm -rf {0} && mkdir {0} && tar xzf {1} -C {0} && rm {1} && touch {0}/.complete'
+                   .format(remote, remote_archive))
+        if pool.execute(address, username, command) != 0:
+            raise UploadFailedException(address)
+        return True
+
+    def close(self):
+        if self._archive is not None:
+            os.unlink(self._archive)
+            self._archive = None
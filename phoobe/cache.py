@@ -0,0 +1,207 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import calendar
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+def fingerprint(data):
+    """Returns a stable hash of a JSON serializable object."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def write_atomic(filename, content, mode=0o600):
+    """Replaces filename with content without exposing partial writes."""
+    directory = os.path.dirname(filename) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as fp:
+            fp.write(content)
+        os.rename(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class TokenCache(object):
+    """Stores auth tokens and service endpoints per cloud on disk.
+
+    Entries are bound to a fingerprint of the auth configuration and are
+    reused until `margin` seconds before the token expires.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, filename, margin=300):
+        self._filename = filename
+        self._margin = margin
+
+    def _load(self):
+        try:
+            with open(self._filename) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, data):
+        write_atomic(self._filename, json.dumps(data))
+
+    def get(self, cloud_name, auth):
+        entry = self._load().get(cloud_name)
+        if not entry or entry.get('fingerprint') != fingerprint(auth):
+            return None
+        if entry.get('expires', 0) - self._margin < time.time():
+            self.log.debug("cached token for cloud '%s' expired" % cloud_name)
+            return None
+        return entry
+
+    def set(self, cloud_name, auth, token, endpoints, expires):
+        """Stores a token.
+
+        :param endpoints: dictionary of service type to endpoint URL
+        :param expires: expiration of the token as datetime object
+        """
+
+        data = self._load()
+        data[cloud_name] = {
+            'fingerprint': fingerprint(auth),
+            'token': token,
+            'endpoints': endpoints,
+            'expires': calendar.timegm(expires.utctimetuple()),
+        }
+        self._save(data)
+
+    def invalidate(self, cloud_name):
+        data = self._load()
+        if data.pop(cloud_name, None) is not None:
+            self.log.debug("invalidated cached token for cloud '%s'" % cloud_name)
+            self._save(data)
+
+
+class LookupCache(object):
+    """Memoizes lookups of cloud resources by kind and name.
+
+    Results are always kept in memory. If a filename and a ttl are given
+    resolved ids are persisted as well and reused for ttl seconds. Misses
+    are never persisted.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, filename=None, ttl=0, namespace='default'):
+        self._filename = filename
+        self._ttl = ttl
+        self._namespace = namespace
+        self._memory = {}
+        self._persistent = None
+
+    def _load(self):
+        if self._persistent is None:
+            self._persistent = {}
+            if self._filename and self._ttl > 0:
+                try:
+                    with open(self._filename) as fp:
+                        self._persistent = json.load(fp)
+                except (IOError, ValueError):
+                    pass
+        return self._persistent.setdefault(self._namespace, {})
+
+    def _save(self):
+        if self._filename and self._ttl > 0:
+            write_atomic(self._filename, json.dumps(self._persistent))
+
+    def get(self, kind, name, func):
+        """Returns the cached value or calls func() to resolve it."""
+
+        key = (kind, name)
+        if key in self._memory:
+            return self._memory[key]
+
+        entries = self._load().setdefault(kind, {})
+        entry = entries.get(name)
+        if entry and entry['time'] + self._ttl > time.time():
+            self.log.debug("using cached %s '%s'" % (kind, name))
+            value = entry['value']
+        else:
+            value = func()
+            if value is not None:
+                entries[name] = {'value': value, 'time': time.time()}
+                self._save()
+
+        self._memory[key] = value
+        return value
+
+
+class TemplateCache(object):
+    """Stores generated templates by the fingerprint of their inputs.
+
+    The templates of nested stacks are stored next to the template, they
+    are written first, so an existing template is always complete.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, directory, max_entries=100):
+        self._directory = directory
+        self._max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self._directory, '%s.yaml' % key)
+
+    def _files_path(self, key):
+        return os.path.join(self._directory, '%s.files.json' % key)
+
+    def get(self, key):
+        """Returns (template, files) or None."""
+        try:
+            with open(self._path(key)) as fp:
+                content = fp.read()
+        except IOError:
+            return None
+        try:
+            with open(self._files_path(key)) as fp:
+                files = json.load(fp)
+        except IOError:
+            files = {}
+        except ValueError:
+            return None
+        self.log.debug("using cached template %s" % key)
+        os.utime(self._path(key), None)
+        return content, files
+
+    def set(self, key, content, files=None):
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+        if files:
+            write_atomic(self._files_path(key), json.dumps(files), 0o644)
+        write_atomic(self._path(key), content, 0o644)
+        self._prune()
+
+    def _prune(self):
+        entries = [os.path.join(self._directory, name)
+                   for name in os.listdir(self._directory) if name.endswith('.yaml')]
+        if len(entries) <= self._max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:len(entries) - self._max_entries]:
+            for path in (entry, entry[:-len('.yaml')] + '.files.json'):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
@@ -0,0 +1,132 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+
+def _timestamp(value):
+    return datetime.datetime.utcfromtimestamp(value).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _native(line):
+    """Returns line as native string, as received from the instance."""
+    if isinstance(line, str):
+        return line
+    if isinstance(line, bytes):
+        return line.decode('utf-8', 'replace')
+    return line.encode('utf-8')
+
+
+def _unicode(line):
+    if isinstance(line, bytes):
+        return line.decode('utf-8', 'replace')
+    return line
+
+
+class OutputWriter(object):
+    """Distributes the output lines of provisioner runs.
+
+    Every line is tagged with the instance, the provisioner, the stream
+    (stdout or stderr) and the time it was received and written
+    immediately: to stdout (prefixed text or JSON lines) and to one log
+    file per instance, nothing is kept in memory.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, stdout=None, log_dir=None, output_format='text'):
+        self._stdout = stdout or sys.stdout
+        self._log_dir = log_dir
+        self._format = output_format
+        self._files = {}
+        self._lock = threading.Lock()
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+    def log_file(self, instance_name):
+        if not self._log_dir:
+            return None
+        return os.path.join(self._log_dir, '%s.log' % instance_name)
+
+    def _write_file(self, instance_name, line):
+        # called with the lock held
+        fp = self._files.get(instance_name)
+        if fp is None and self._log_dir:
+            fp = self._files[instance_name] = open(self.log_file(instance_name), 'a')
+        if fp:
+            fp.write(line + '\n')
+            fp.flush()
+
+    def _prefix(self, instance_name, provisioner_name):
+        if provisioner_name:
+            return '[%s, %s]' % (instance_name, provisioner_name)
+        return '[%s]' % instance_name
+
+    def write(self, instance_name, provisioner_name, line, stream='stdout', timestamp=None):
+        """Writes a single line of output of a task."""
+
+        line = _native(line).rstrip('\r\n')
+        record = {
+            'time': _timestamp(timestamp or time.time()),
+            'instance': instance_name,
+            'provisioner': provisioner_name,
+            'stream': stream,
+            'line': _unicode(line),
+        }
+        prefix = self._prefix(instance_name, provisioner_name)
+        if stream != 'stdout':
+            prefix = '%s %s' % (prefix, stream)
+        with self._lock:
+            if self._format == 'json':
+                self._stdout.write(json.dumps(record, sort_keys=True) + '\n')
+            else:
+                self._stdout.write('%s: %s\n' % (prefix, line))
+            self._stdout.flush()
+            self._write_file(instance_name, '%s %s %s %s' % (record['time'], provisioner_name or '-',
+                                                             stream, line))
+
+    def event(self, instance_name, provisioner_name, event, message=None, **fields):
+        """Writes a state change of a task, e.g. started or finished.
+
+        :param message: printed in text format, otherwise events only go
+                        to the log files
+        """
+
+        record = dict(fields)
+        record.update({
+            'time': _timestamp(time.time()),
+            'instance': instance_name,
+            'provisioner': provisioner_name,
+            'event': event,
+        })
+        details = ''.join(' %s=%s' % item for item in sorted(fields.items()))
+        with self._lock:
+            if self._format == 'json':
+                self._stdout.write(json.dumps(record, sort_keys=True) + '\n')
+                self._stdout.flush()
+            elif message:
+                self._stdout.write('%s: %s\n' % (self._prefix(instance_name, provisioner_name), message))
+                self._stdout.flush()
+            self._write_file(instance_name, '%s %s %s%s' % (record['time'], provisioner_name or '-',
+                                                            event, details))
+
+    def close(self):
+        with self._lock:
+            for fp in self._files.values():
+                fp.close()
+            self._files.clear()
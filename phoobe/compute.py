@@ -0,0 +1,57 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+from attrdict import AttrDict
+
+
+class UnauthorizedException(Exception):
+    pass
+
+
+class ComputeClient(object):
+    """Lists servers with a cached token and compute endpoint.
+
+    Unlike the SDK connection it does not authenticate against Keystone,
+    the token and the endpoint come from the token cache.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, endpoint, token, timeout=60):
+        self._endpoint = endpoint.rstrip('/')
+        self._token = token
+        self._timeout = timeout
+
+    def servers(self, name=None):
+        """Returns the servers (with details) whose name matches the regex name."""
+
+        import requests
+
+        url = self._endpoint + '/servers/detail'
+        params = {'name': name} if name else {}
+        servers = []
+        while url:
+            response = requests.get(url, params=params, timeout=self._timeout,
+                                    headers={'X-Auth-Token': self._token,
+                                             'Accept': 'application/json'})
+            if response.status_code == 401:
+                raise UnauthorizedException(url)
+            response.raise_for_status()
+            data = response.json()
+            servers.extend(AttrDict(server) for server in data.get('servers', []))
+            # the next link already contains the query
+            url = next((link['href'] for link in data.get('servers_links', [])
+                        if link.get('rel') == 'next'), None)
+            params = {}
+        return servers
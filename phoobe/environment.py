@@ -1,32 +1,102 @@
+import hashlib
 import logging
 import os
-import yaml
 
-import networkx as nx
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
+from phoobe import cache
 from phoobe import defaults
+from phoobe import utils
+
+# increase whenever the normalized environment (or the defaults) change
+_snapshot_version = 1
+
+class UnknownDependencyException(Exception):
+    pass
+
+class DependencyCycleException(Exception):
+    pass
 
 class Environment(object):
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, filename='environment.yaml', name='phoobe'):
+    def __init__(self, filename='environment.yaml', name='phoobe', snapshot_dir=None):
         self._name = name
         self._filename = filename
+        self._snapshot_dir = snapshot_dir
         self._networks = {}
         self._instances = {}
+        self._groups = {}
         self._provisioners = {}
-        self._object_tree = nx.DiGraph()
-
-        self._load_configuration_from_file()
-        self._load_networks()
-        self._load_instances()
-        self._load_provisioners()
+        self._object_tree = None
+
+        # the key is taken before reading, a file changed meanwhile is
+        # parsed again the next time
+        key = self._snapshot_key()
+        if not self._load_snapshot(key):
+            self._load_configuration_from_file()
+            self._load_networks()
+            self._load_instances()
+            self._load_provisioners()
+            self._save_snapshot(key)
 
     def _load_configuration_from_file(self):
-        self._data = yaml.load(open(self._filename, 'r'))
+        with open(self._filename, 'r') as fp:
+            self._data = utils.load_yaml(fp)
         self._defaults = self._data.get('defaults', {})
 
+    def _snapshot_key(self):
+        stat = os.stat(self._filename)
+        return (_snapshot_version, os.path.abspath(self._filename), stat.st_mtime, stat.st_size)
+
+    def _snapshot_file(self):
+        path = os.path.abspath(self._filename).encode('utf-8')
+        return os.path.join(self._snapshot_dir, '%s.pickle' % hashlib.sha256(path).hexdigest())
+
+    def _load_snapshot(self, key):
+        """Restores the normalized environment of an unchanged file."""
+
+        if not self._snapshot_dir:
+            return False
+        try:
+            with open(self._snapshot_file(), 'rb') as fp:
+                snapshot = pickle.load(fp)
+        except IOError:
+            return False
+        except Exception as e:
+            self.log.debug("ignoring broken snapshot of %s: %s" % (self._filename, e))
+            return False
+        if snapshot.get('key') != key:
+            return False
+        self.log.debug("using snapshot of %s" % self._filename)
+        self._networks = snapshot['networks']
+        self._instances = snapshot['instances']
+        self._groups = snapshot['groups']
+        self._provisioners = snapshot['provisioners']
+        return True
+
+    def _save_snapshot(self, key):
+        if not self._snapshot_dir:
+            return
+        snapshot = {
+            'key': key,
+            'networks': self._networks,
+            'instances': self._instances,
+            'groups': self._groups,
+            'provisioners': self._provisioners,
+        }
+        try:
+            if not os.path.exists(self._snapshot_dir):
+                os.makedirs(self._snapshot_dir)
+            cache.write_atomic(self._snapshot_file(),
+                               pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError) as e:
+            self.log.debug("could not write snapshot of %s: %s" % (self._filename, e))
+
     def _apply_defaults(self, resource_type, resource):
         global_defaults = defaults.get_defaults(resource_type).copy()
         environment_defaults = self._defaults.get(resource_type, {})
@@ -39,6 +109,65 @@ class Environment(object):
             provisioner = self._data['provisioners'][provisioner_name]
             self._provisioners[provisioner_name] = provisioner
 
+    def _load_dependencies(self):
+        """Builds the graph of (instance, provisioner) tasks.
+
+        The provisioners of an instance run in the listed order. A
+        provisioner depending on another provisioner waits until it
+        finished on all instances, a provisioner depending on an instance
+        (or instance group) waits for all provisioners of that instance.
+        """
+
+        import networkx as nx
+
+        self._object_tree = nx.DiGraph()
+        by_provisioner = {}
+        by_instance = {}
+        for instance_name in sorted(self._instances):
+            instance = self._instances[instance_name]
+            previous = None
+            for provisioner_name in instance.get('provisioners', []):
+                node = (instance_name, provisioner_name)
+                self._object_tree.add_node(node)
+                by_provisioner.setdefault(provisioner_name, []).append(node)
+                by_instance.setdefault(instance_name, []).append(node)
+                if 'group' in instance:
+                    by_instance.setdefault(instance['group'], []).append(node)
+                if previous:
+                    self._object_tree.add_edge(previous, node)
+                previous = node
+
+        for node in list(self._object_tree.nodes()):
+            instance_name, provisioner_name = node
+            dependencies = self._provisioners.get(provisioner_name, {}).get('depends_on', [])
+            if not isinstance(dependencies, list):
+                dependencies = [dependencies]
+            for dependency in dependencies:
+                if dependency in self._provisioners:
+                    prerequisites = by_provisioner.get(dependency, [])
+                elif dependency in self._instances or dependency in self._groups:
+                    # waiting for the own instance is meaningless
+                    prerequisites = [prerequisite for prerequisite in by_instance.get(dependency, [])
+                                     if prerequisite[0] != instance_name]
+                    instance = self._instances[instance_name]
+                    if dependency == instance.get('group'):
+                        # the other members run the same provisioners, only
+                        # the ones before this provisioner can be waited for
+                        provisioners = instance.get('provisioners', [])
+                        earlier = provisioners[:provisioners.index(provisioner_name)]
+                        prerequisites = [prerequisite for prerequisite in prerequisites
+                                         if prerequisite[1] in earlier]
+                else:
+                    raise UnknownDependencyException(dependency)
+                for prerequisite in prerequisites:
+                    if prerequisite != node:
+                        self.log.debug("provisioner task %s depends on %s" % (node, prerequisite))
+                        self._object_tree.add_edge(prerequisite, node)
+
+        if not nx.is_directed_acyclic_graph(self._object_tree):
+            cycle = next(nx.simple_cycles(self._object_tree))
+            raise DependencyCycleException(' -> '.join('%s/%s' % node for node in cycle))
+
     def _load_instances(self):
         for instance_name in self._data.get('instances', {}):
             instance = self._data['instances'][instance_name]
@@ -47,10 +176,18 @@ class Environment(object):
                 instance['name'] = instance_name
             self.log.debug("loaded instance '%s': %s" % (instance_name, instance))
 
-            for network_name in instance.get('networks', [instance['network']]):
+            for network_name in instance.get('networks') or [instance['network']]:
                 self.log.debug("adding instance '%s' to network '%s'" % (instance_name, network_name))
 
-            self._instances[instance_name] = instance
+            if 'count' in instance:
+                # members of a group are addressed as <group>_<index>
+                self._groups[instance_name] = instance
+                for index in range(int(instance['count'])):
+                    member_name = '%s_%d' % (instance_name, index)
+                    member = dict(instance, name=member_name, group=instance_name, index=index)
+                    self._instances[member_name] = member
+            else:
+                self._instances[instance_name] = instance
 
     def _load_networks(self):
         for network_name in self._data.get('networks', {}):
@@ -67,10 +204,26 @@ class Environment(object):
     def instances(self):
         return self._instances
 
+    @property
+    def groups(self):
+        return self._groups
+
     @property
     def provisioners(self):
         return self._provisioners
 
+    @property
+    def provisioning_graph(self):
+        """Directed graph of (instance, provisioner) tasks."""
+        # built on first use, networkx is only needed for provisioning
+        if self._object_tree is None:
+            try:
+                self._load_dependencies()
+            except Exception:
+                self._object_tree = None
+                raise
+        return self._object_tree
+
     @property
     def name(self):
         return self._name
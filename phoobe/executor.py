@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class DependencyFailedException(Exception):
+    pass
+
+
+class Executor(object):
+    """Runs a task for a list of items using a bounded pool of workers."""
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, parallel=1):
+        self._parallel = max(1, parallel or 1)
+
+    @property
+    def parallel(self):
+        return self._parallel
+
+    def map(self, func, items):
+        """Calls func for every item and returns a list of (item, result).
+
+        Exceptions raised by func are not propagated, they are returned
+        as the result of the item instead.
+        """
+
+        items = list(items)
+        if not items:
+            return []
+
+        def wrapper(item):
+            try:
+                return func(item)
+            except Exception as e:
+                self.log.debug("task for '%s' failed: %s" % (item, e))
+                return e
+
+        if self._parallel == 1 or len(items) == 1:
+            return [(item, wrapper(item)) for item in items]
+
+        pool = ThreadPool(min(self._parallel, len(items)))
+        try:
+            results = pool.map(wrapper, items)
+        finally:
+            pool.close()
+            pool.join()
+        return list(zip(items, results))
+
+    def gather(self, *funcs):
+        """Calls all funcs concurrently and returns their results in order.
+
+        The first exception raised by any of the funcs is re-raised.
+        """
+
+        results = self.map(lambda func: func(), funcs)
+        for func, result in results:
+            if isinstance(result, Exception):
+                raise result
+        return [result for (func, result) in results]
+
+    def run_graph(self, func, graph, succeeded=None):
+        """Calls func for every node of a directed acyclic graph.
+
+        A node is started as soon as all of its predecessors succeeded,
+        independent nodes run concurrently. Nodes depending on a failed
+        node are not started, their result is a DependencyFailedException.
+
+        :param succeeded: tells if a result is successful, by default
+                          every result which is not an exception
+        :returns: dictionary mapping nodes to results
+        """
+
+        succeeded = succeeded or (lambda result: not isinstance(result, Exception))
+        pending = dict((node, set(graph.predecessors(node))) for node in graph.nodes())
+        results = {}
+        if not pending:
+            return results
+
+        done = queue.Queue()
+        pool = ThreadPool(min(self._parallel, len(pending)))
+
+        def wrapper(node):
+            try:
+                result = func(node)
+            except Exception as e:
+                self.log.debug("task for '%s' failed: %s" % (node, e))
+                result = e
+            done.put((node, result))
+
+        def start_ready():
+            started = 0
+            for node in sorted(node for node in pending if not pending[node]):
+                del pending[node]
+                pool.apply_async(wrapper, (node,))
+                started += 1
+            return started
+
+        try:
+            running = start_ready()
+            while running:
+                node, result = done.get()
+                running -= 1
+                results[node] = result
+                if succeeded(result):
+                    for successor in graph.successors(node):
+                        if successor in pending:
+                            pending[successor].discard(node)
+                else:
+                    for descendant in _descendants(graph, node):
+                        if descendant in pending:
+                            del pending[descendant]
+                            results[descendant] = DependencyFailedException(node)
+                running += start_ready()
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+def _descendants(graph, node):
+    """Returns all nodes reachable from node."""
+    seen = set()
+    stack = list(graph.successors(node))
+    while stack:
+        current = stack.pop()
+        if current not in seen:
+            seen.add(current)
+            stack.extend(graph.successors(current))
+    return seen
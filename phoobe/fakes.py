@@ -0,0 +1,528 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process stand-in for the OpenStack APIs used by phoobe.
+
+FakeCloud implements the calls phoobe makes to Keystone, Heat, Neutron and
+Nova on top of in-memory data. Every call is counted and can be delayed to
+simulate latency, stacks move from IN_PROGRESS to COMPLETE after a
+configurable time. Use run() to execute a phoobe command against it:
+
+    cloud = fakes.FakeCloud(latency=0.05)
+    fakes.run(cloud, ['--environment-file', 'environment.yaml', 'status'], data_dir)
+    assert cloud.total_calls <= 3
+"""
+
+import collections
+import datetime
+import itertools
+import logging
+import re
+import threading
+import time
+import uuid
+
+from phoobe import tracing
+from phoobe import utils
+
+try:
+    from heatclient.exc import HTTPConflict
+    from heatclient.exc import HTTPNotFound
+except ImportError:
+    class HTTPNotFound(Exception):
+        pass
+
+    class HTTPConflict(Exception):
+        pass
+
+FAKE_PRIVATE_KEY = 'fake-private-key'
+
+
+class FakeResource(dict):
+    """A resource of an API, its items are available as attributes as well."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeCloud(object):
+    """In-memory cloud with API call counter and latency injection.
+
+    :param latency: seconds added to every call, or a dictionary mapping
+                    call names (e.g. 'heat.stacks.get') to seconds, with
+                    the key 'default' for all other calls
+    :param stack_duration: seconds a stack action stays IN_PROGRESS
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, latency=0.0, stack_duration=0.0,
+                 flavors=('m1.tiny', 'm1.small', 'm1.medium'),
+                 images=('cirros', 'ubuntu'),
+                 external_networks=('public',)):
+        self.latency = latency
+        self.stack_duration = stack_duration
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._stacks = {}
+
+        self.flavors = [FakeResource(id=self._id('flavor'), name=name) for name in flavors]
+        self.images = [FakeResource(id=self._id('image'), name=name, status='active')
+                       for name in images]
+        self.networks = []
+        self.subnets = []
+        for name in external_networks:
+            self.add_network(name, '198.51.100.0/24', external=True)
+
+        self.connection = FakeConnection(self)
+        self.heat = FakeHeatClient(self)
+        self.compute = FakeComputeService(self)
+
+    def _id(self, prefix):
+        return '%s-%d' % (prefix, next(self._ids))
+
+    def call(self, name):
+        """Counts a call and sleeps for its latency."""
+        start = time.time()
+        with self._lock:
+            self.calls[name] += 1
+        if isinstance(self.latency, dict):
+            delay = self.latency.get(name, self.latency.get('default', 0.0))
+        else:
+            delay = self.latency
+        if delay:
+            time.sleep(delay)
+        tracing.record('api fake %s' % name, start, time.time(), 'api')
+
+    @property
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def add_network(self, name, cidr, external=False):
+        subnet = FakeResource(id=self._id('subnet'), name='%s_subnet' % name, cidr=cidr)
+        network = FakeResource(id=self._id('network'), name=name, status='ACTIVE',
+                               subnets=[subnet.id])
+        network['router:external'] = external
+        subnet['network_id'] = network.id
+        self.networks.append(network)
+        self.subnets.append(subnet)
+        return network
+
+    # stacks
+
+    def _find_stack(self, name_or_id):
+        name_or_id = name_or_id.split('/')[-1]
+        for stack in self._stacks.values():
+            if name_or_id in (stack['id'], stack['name']):
+                self._progress(stack)
+                if stack['status'] != 'DELETE_COMPLETE':
+                    return stack
+        raise HTTPNotFound('stack %s not found' % name_or_id)
+
+    def _start(self, stack, action):
+        now = time.time()
+        stack['action'] = action
+        stack['status'] = '%s_IN_PROGRESS' % action
+        stack['finish'] = now + self.stack_duration
+        self._add_event(stack, stack['status'], 'Stack %s started' % action, now)
+        self._progress(stack)
+
+    def _progress(self, stack):
+        if stack['status'].endswith('_IN_PROGRESS') and time.time() >= stack['finish']:
+            stack['status'] = '%s_COMPLETE' % stack['action']
+            self._add_event(stack, stack['status'], 'Stack %s completed successfully'
+                            % stack['action'], stack['finish'])
+
+    def _add_event(self, stack, status, reason, timestamp):
+        stack['events'].append(FakeResource(
+            id=self._id('event'),
+            event_time=datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            resource_name=stack['name'],
+            logical_resource_id=stack['name'],
+            physical_resource_id=stack['id'],
+            resource_status=status,
+            resource_status_reason=reason,
+        ))
+
+    def _outputs(self, stack):
+        outputs = []
+        for key in sorted(stack['template'].get('outputs') or {}):
+            if key == 'private_ssh_key':
+                value = FAKE_PRIVATE_KEY
+            elif key.startswith('floatingips_'):
+                group = stack['template']['resources'][key[len('floatingips_'):]]
+                value = [self._address(stack, '%s_%d' % (key, index))
+                         for index in range(int(group['properties']['count']))]
+            elif key.startswith('floatingip_'):
+                value = self._address(stack, key)
+            else:
+                value = None
+            outputs.append({'output_key': key, 'output_value': value})
+        return outputs
+
+    def _address(self, stack, key):
+        addresses = stack['addresses']
+        if not key in addresses:
+            index = len(addresses) + 1
+            addresses[key] = '203.0.113.%d' % index if index < 255 else '203.0.%d.%d' % divmod(index, 254)
+        return addresses[key]
+
+    def _servers(self, stack, template, physical_prefix, parameters=None):
+        """Yields the servers of a template, including nested stacks.
+
+        Like Heat the properties of a nested stack are its parameters and
+        %index% is only replaced in the resource_def of a group.
+        """
+
+        for name, resource in sorted((template.get('resources') or {}).items()):
+            properties = resource.get('properties') or {}
+            physical_id = '%s-%s' % (physical_prefix, name)
+            if physical_prefix == stack['id'] and stack['replaced'].get(name):
+                physical_id += '-%d' % stack['replaced'][name]
+            if resource.get('type') == 'OS::Nova::Server':
+                server_name = _resolve(properties.get('name'), parameters or {})
+                if not isinstance(server_name, str):
+                    continue
+                yield FakeResource(
+                    id=physical_id, name=server_name,
+                    status='ACTIVE' if stack['status'].endswith('_COMPLETE') else 'BUILD',
+                    addresses={'private': [{'addr': '10.0.0.%d' % (len(physical_id) % 250 + 2),
+                                            'OS-EXT-IPS:type': 'fixed'}]})
+            elif resource.get('type') in stack['files']:
+                nested = _load_template(stack['files'][resource['type']])
+                for server in self._servers(stack, nested, physical_id,
+                                            _resolve(properties, parameters or {})):
+                    yield server
+            elif resource.get('type') == 'OS::Heat::ResourceGroup':
+                definition = properties['resource_def']
+                if not definition.get('type') in stack['files']:
+                    continue
+                nested = _load_template(stack['files'][definition['type']])
+                for index in range(int(properties['count'])):
+                    member = _resolve(definition.get('properties') or {}, parameters or {},
+                                      {'%index%': str(index)})
+                    for server in self._servers(stack, nested, '%s-%d' % (physical_id, index), member):
+                        yield server
+
+
+class FakeConnection(object):
+    """Stand-in for openstack.connection.Connection.
+
+    Like the session of the SDK it authenticates with the first request
+    and reuses the token for all further requests.
+    """
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+        self._lock = threading.Lock()
+        self._authenticated = False
+        self.network = FakeNetworkService(cloud, self)
+        self.compute = FakeComputeService(cloud, self)
+        self.session = FakeResource(authenticator=FakeResource(auth_plugin=FakeAuthPlugin(cloud, self)))
+        self.transport = None
+
+    def authenticate(self, force=False):
+        with self._lock:
+            if self._authenticated and not force:
+                return
+            self._authenticated = True
+        self._cloud.call('identity.authorize')
+
+
+class FakeAuthPlugin(object):
+
+    def __init__(self, cloud, connection):
+        self._cloud = cloud
+        self._connection = connection
+
+    def authorize(self, transport):
+        self._connection.authenticate(force=True)
+        catalog = FakeResource(get_url=lambda service_filter: 'http://heat.fake:8004/v1/fake')
+        return FakeResource(auth_token=uuid.uuid4().hex, service_catalog=catalog,
+                            expires=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+
+
+def _matches(item, query):
+    return all(item.get(key) == value for key, value in query.items())
+
+
+class FakeService(object):
+    """Counts the calls of a service and the authentication of its connection.
+
+    Without a connection the service stands for a client with a cached
+    token, e.g. phoobe.compute.ComputeClient.
+    """
+
+    def __init__(self, cloud, connection=None):
+        self._cloud = cloud
+        self._connection = connection
+
+    def _call(self, name):
+        if self._connection is not None:
+            self._connection.authenticate()
+        self._cloud.call(name)
+
+
+class FakeNetworkService(FakeService):
+
+    def find_network(self, name_or_id):
+        self._call('network.find_network')
+        for network in self._cloud.networks:
+            if name_or_id in (network.id, network.name):
+                return network
+        return None
+
+    def networks(self, **query):
+        self._call('network.networks')
+        return [network for network in self._cloud.networks if _matches(network, query)]
+
+    def subnets(self, **query):
+        self._call('network.subnets')
+        return [subnet for subnet in self._cloud.subnets if _matches(subnet, query)]
+
+    def get_subnet(self, subnet_id):
+        self._call('network.get_subnet')
+        for subnet in self._cloud.subnets:
+            if subnet.id == subnet_id:
+                return subnet
+        raise HTTPNotFound('subnet %s not found' % subnet_id)
+
+
+class FakeComputeService(FakeService):
+
+    def flavors(self):
+        self._call('compute.flavors')
+        return list(self._cloud.flavors)
+
+    def images(self):
+        self._call('compute.images')
+        return list(self._cloud.images)
+
+    def servers(self, name=None):
+        self._call('compute.servers')
+        servers = []
+        for stack in list(self._cloud._stacks.values()):
+            self._cloud._progress(stack)
+            if stack['status'] == 'DELETE_COMPLETE':
+                continue
+            servers.extend(self._cloud._servers(stack, stack['template'], stack['id']))
+        if name:
+            servers = [server for server in servers if re.search(name, server.name)]
+        return servers
+
+
+class FakeHeatClient(object):
+    """Stand-in for heatclient.v1.client.Client."""
+
+    def __init__(self, cloud):
+        self.stacks = FakeStackManager(cloud)
+        self.resources = FakeResourceManager(cloud)
+        self.events = FakeEventManager(cloud)
+
+
+def _nested_type(resource):
+    if resource.get('type') == 'OS::Heat::ResourceGroup':
+        return resource['properties']['resource_def']['type']
+    return resource.get('type')
+
+
+def _resolve(value, parameters, replace=None):
+    """Resolves get_param and str_replace of a property value.
+
+    Other functions are kept, strings get the replacements of replace.
+    """
+
+    if isinstance(value, dict):
+        if 'get_param' in value:
+            return parameters.get(value['get_param'])
+        if 'str_replace' in value:
+            result = _resolve(value['str_replace']['template'], parameters, replace)
+            for old, new in value['str_replace']['params'].items():
+                new = _resolve(new, parameters, replace)
+                if isinstance(result, str) and isinstance(new, str):
+                    result = result.replace(old, new)
+            return result
+        return dict((key, _resolve(item, parameters, replace)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_resolve(item, parameters, replace) for item in value]
+    if isinstance(value, str):
+        for old, new in (replace or {}).items():
+            value = value.replace(old, new)
+    return value
+
+
+def _load_template(template):
+    return template if isinstance(template, dict) else utils.load_yaml(template)
+
+
+class FakeStackManager(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def create(self, stack_name, template, files=None, **kwargs):
+        self._cloud.call('heat.stacks.create')
+        try:
+            self._cloud._find_stack(stack_name)
+        except HTTPNotFound:
+            pass
+        else:
+            raise HTTPConflict('stack %s already exists' % stack_name)
+        stack = {
+            'id': str(uuid.uuid4()),
+            'name': stack_name,
+            'template': _load_template(template),
+            'files': files or {},
+            'events': [],
+            'addresses': {},
+            'replaced': {},
+        }
+        self._cloud._stacks[stack['id']] = stack
+        self._cloud._start(stack, 'CREATE')
+        return {'stack': {'id': stack['id']}}
+
+    def get(self, stack_id):
+        self._cloud.call('heat.stacks.get')
+        stack = self._cloud._find_stack(stack_id)
+        complete = stack['status'] in ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+        return FakeResource(
+            id=stack['id'],
+            stack_name=stack['name'],
+            stack_status=stack['status'],
+            stack_status_reason=stack['events'][-1].resource_status_reason,
+            outputs=self._cloud._outputs(stack) if complete else [],
+        )
+
+    def delete(self, stack_id):
+        self._cloud.call('heat.stacks.delete')
+        self._cloud._start(self._cloud._find_stack(stack_id), 'DELETE')
+
+    def update(self, stack_id, template, files=None, **kwargs):
+        self._cloud.call('heat.stacks.update')
+        stack = self._cloud._find_stack(stack_id)
+        template = _load_template(template)
+        files = files or {}
+        # changed resources are replaced and get new physical IDs
+        old = stack['template'].get('resources') or {}
+        for name, resource in (template.get('resources') or {}).items():
+            nested_type = _nested_type(resource)
+            if name in old and (old[name] != resource or
+                                stack['files'].get(nested_type) != files.get(nested_type)):
+                stack['replaced'][name] = stack['replaced'].get(name, 0) + 1
+        stack['template'] = template
+        stack['files'] = files
+        self._cloud._start(stack, 'UPDATE')
+
+    def preview_update(self, stack_id, template, files=None, **kwargs):
+        self._cloud.call('heat.stacks.preview_update')
+        old = self._cloud._find_stack(stack_id)['template'].get('resources') or {}
+        new = _load_template(template).get('resources') or {}
+        changes = {'added': [], 'deleted': [], 'updated': [], 'unchanged': []}
+        for name in sorted(set(old) | set(new)):
+            if not name in old:
+                change = 'added'
+            elif not name in new:
+                change = 'deleted'
+            elif old[name] != new[name]:
+                change = 'updated'
+            else:
+                change = 'unchanged'
+            changes[change].append({'resource_name': name})
+        return {'resource_changes': changes}
+
+    def template(self, stack_id):
+        self._cloud.call('heat.stacks.template')
+        return self._cloud._find_stack(stack_id)['template']
+
+
+class FakeResourceManager(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def list(self, stack_id, nested_depth=0):
+        self._cloud.call('heat.resources.list')
+        stack = self._cloud._find_stack(stack_id)
+        return list(self._resources(stack, stack['template'], stack['id'], nested_depth))
+
+    def _resources(self, stack, template, physical_prefix, depth):
+        for name, resource in sorted((template.get('resources') or {}).items()):
+            physical_id = '%s-%s' % (physical_prefix, name)
+            yield FakeResource(resource_name=name,
+                               resource_type=resource.get('type'),
+                               resource_status=stack['status'],
+                               physical_resource_id=physical_id)
+            if depth > 0 and resource.get('type') in stack['files']:
+                nested = _load_template(stack['files'][resource['type']])
+                for nested_resource in self._resources(stack, nested, physical_id, depth - 1):
+                    yield nested_resource
+
+
+class FakeEventManager(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def list(self, stack_id, sort_dir='asc', marker=None, limit=None, **kwargs):
+        self._cloud.call('heat.events.list')
+        try:
+            events = list(self._cloud._find_stack(stack_id)['events'])
+        except HTTPNotFound:
+            # events of deleted stacks are still available by id
+            stack = self._cloud._stacks.get(stack_id.split('/')[-1])
+            if not stack:
+                raise
+            events = list(stack['events'])
+        if marker:
+            ids = [event.id for event in events]
+            events = events[ids.index(marker) + 1:] if marker in ids else events
+        if sort_dir == 'desc':
+            events.reverse()
+        return events[:limit] if limit else events
+
+
+def run(cloud, argv, data_dir, stdout=None):
+    """Runs a phoobe command against cloud and returns its exit code.
+
+    The registry and the caches are stored in data_dir.
+    """
+
+    from phoobe import shell
+
+    class FakeShell(shell.PhoobeShell):
+
+        def connect(self):
+            self.cloud = FakeResource(config={'auth': {'auth_url': 'http://keystone.fake:5000/v2.0',
+                                                       'username': 'fake'}})
+            # a new connection per command, it authenticates again
+            return FakeConnection(cloud)
+
+        def heat_client(self, endpoint, token):
+            return cloud.heat
+
+        def compute_client(self, endpoint, token):
+            return cloud.compute
+
+    app = FakeShell()
+    app.data_dir = data_dir
+    if stdout is not None:
+        app.stdout = stdout
+    return app.run(argv)
@@ -0,0 +1,179 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import time
+
+from phoobe import tracing
+
+
+class StackActionFailedException(Exception):
+    pass
+
+class StackTimeoutException(Exception):
+    pass
+
+
+def get_addresses(outputs):
+    """Returns the floating IP addresses of all instances of a stack.
+
+    Members of instance groups are named <group>_<index>.
+    """
+
+    addresses = {}
+    for output in outputs or []:
+        key, value = output['output_key'], output['output_value']
+        if key.startswith('floatingip_'):
+            addresses[key[11:]] = value
+        elif key.startswith('floatingips_'):
+            # the attribute of a group is the list of its members
+            for index, address in enumerate(value or []):
+                addresses['%s_%d' % (key[12:], index)] = address
+    return addresses
+
+
+def _provider_template(resource):
+    """Returns the file of the nested stack template of a resource."""
+    resource_type = resource.get('type')
+    if resource_type == 'OS::Heat::ResourceGroup':
+        resource_type = ((resource.get('properties') or {}).get('resource_def') or {}).get('type')
+    if resource_type and resource_type.endswith('.yaml'):
+        return resource_type
+    return None
+
+
+def diff_templates(old, new, old_files=None, new_files=None):
+    """Compares the resources of two templates.
+
+    Resources using a nested stack template (provider templates passed as
+    files) are changed as well if the hash of their template changed.
+
+    :param old_files: dictionary mapping the files of the old template to
+                      their hashes, None if unknown
+    :param new_files: the same for the new template
+    :returns: dictionary with the lists of added, removed and changed
+              resource names
+    """
+
+    old_resources = (old or {}).get('resources') or {}
+    new_resources = (new or {}).get('resources') or {}
+
+    def changed(name):
+        if old_resources[name] != new_resources[name]:
+            return True
+        filename = _provider_template(new_resources[name])
+        if filename is None or old_files is None:
+            return False
+        return old_files.get(filename) != (new_files or {}).get(filename)
+
+    return {
+        'added': sorted(set(new_resources) - set(old_resources)),
+        'removed': sorted(set(old_resources) - set(new_resources)),
+        'changed': sorted(name for name in set(old_resources) & set(new_resources)
+                          if changed(name)),
+    }
+
+
+class StackWatcher(object):
+    """Follows the event stream of a stack until an action is finished.
+
+    Only events newer than the last seen event are fetched (marker), the
+    poll interval is reset whenever new events arrive and backs off while
+    the stack is idle.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, heat, stack_name, stack_id, callback=None,
+                 min_interval=1.0, max_interval=10.0):
+        self._heat = heat
+        self._stack_name = stack_name
+        self._stack_id = stack_id
+        self._callback = callback
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._marker = None
+        self._seen = set()
+
+    @property
+    def _identifier(self):
+        return '%s/%s' % (self._stack_name, self._stack_id)
+
+    def _new_events(self):
+        kwargs = {'sort_dir': 'asc'}
+        if self._marker:
+            kwargs['marker'] = self._marker
+        events = []
+        for event in self._heat.events.list(self._identifier, **kwargs):
+            if event.id in self._seen:
+                continue
+            self._seen.add(event.id)
+            self._marker = event.id
+            events.append(event)
+        return events
+
+    def _stack_status(self, events):
+        # heat emits events for the stack itself, use them if available
+        for event in reversed(events):
+            if event.resource_name == self._stack_name and \
+               getattr(event, 'physical_resource_id', None) == self._stack_id:
+                return event.resource_status, event.resource_status_reason
+        return None, None
+
+    def mark(self):
+        """Ignores all events which exist so far."""
+        for event in self._heat.events.list(self._identifier, sort_dir='desc', limit=1):
+            self._seen.add(event.id)
+            self._marker = event.id
+
+    def _is_terminal(self, action, status):
+        return status in ('%s_COMPLETE' % action, '%s_FAILED' % action)
+
+    def wait(self, action, timeout=None):
+        """Waits for the action (CREATE, UPDATE, DELETE) and returns the status."""
+        with tracing.span('stack wait %s' % action, stack=self._stack_name):
+            return self._wait(action, timeout)
+
+    def _wait(self, action, timeout):
+
+        from heatclient import exc
+
+        deadline = time.time() + timeout if timeout else None
+        interval = self._min_interval
+        while True:
+            try:
+                events = self._new_events()
+                status, reason = self._stack_status(events)
+                if not events:
+                    stack = self._heat.stacks.get(self._stack_id)
+                    status, reason = stack.stack_status, stack.stack_status_reason
+            except exc.HTTPNotFound:
+                if action == 'DELETE':
+                    return 'DELETE_COMPLETE'
+                raise
+
+            for event in events:
+                if self._callback:
+                    self._callback(event)
+
+            if self._is_terminal(action, status):
+                if status.endswith('_FAILED'):
+                    raise StackActionFailedException(reason)
+                return status
+
+            if deadline and time.time() >= deadline:
+                raise StackTimeoutException(self._stack_name)
+
+            interval = self._min_interval if events else min(self._max_interval, interval * 2)
+            if deadline:
+                interval = max(0, min(interval, deadline - time.time()))
+            time.sleep(interval)
@@ -0,0 +1,205 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import glob
+import json
+import logging
+import shelve
+import sqlite3
+import threading
+import time
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS environments (
+    name TEXT PRIMARY KEY,
+    id TEXT,
+    filename TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS environments_id ON environments (id);
+CREATE INDEX IF NOT EXISTS environments_filename ON environments (filename);
+CREATE TABLE IF NOT EXISTS provisioned (
+    stack_id TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    provisioner TEXT NOT NULL,
+    server TEXT,
+    hash TEXT NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (stack_id, instance, provisioner)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class Registry(object):
+    """Stores the created environments in a SQLite database.
+
+    The database runs in WAL mode, so several phoobe processes can read
+    and write it at the same time. Every write is a single transaction.
+    The registry behaves like the dictionary of the former shelve file,
+    mapping environment names to dictionaries with id, filename and name.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, filename, timeout=30):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=timeout,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA busy_timeout=%d' % (timeout * 1000))
+        self._enable_wal(timeout)
+        # single statements, executescript does not retry statements
+        # prepared before another process changed the schema
+        with self._immediate():
+            for statement in _schema.split(';'):
+                if statement.strip():
+                    self._db.execute(statement)
+            # records of former versions without server run again
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(provisioned)')]
+            if not 'server' in columns:
+                self._db.execute('ALTER TABLE provisioned ADD COLUMN server TEXT')
+
+    def _enable_wal(self, timeout):
+        # switching a new database to WAL does not wait for the busy
+        # timeout, processes creating it at the same time have to retry
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self._db.execute('PRAGMA journal_mode=WAL')
+                return
+            except sqlite3.OperationalError:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    @contextlib.contextmanager
+    def _immediate(self):
+        """Runs the block in one BEGIN IMMEDIATE transaction."""
+        with self._lock:
+            # transactions are controlled explicitly
+            isolation_level = self._db.isolation_level
+            self._db.isolation_level = None
+            try:
+                self._db.execute('BEGIN IMMEDIATE')
+                try:
+                    yield
+                    self._db.execute('COMMIT')
+                except Exception:
+                    self._db.execute('ROLLBACK')
+                    raise
+            finally:
+                self._db.isolation_level = isolation_level
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            with self._db:
+                return self._db.execute(sql, parameters).fetchall()
+
+    def __contains__(self, name):
+        return bool(self._execute('SELECT 1 FROM environments WHERE name = ?', (name,)))
+
+    def __getitem__(self, name):
+        rows = self._execute('SELECT data FROM environments WHERE name = ?', (name,))
+        if not rows:
+            raise KeyError(name)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, name, value):
+        self._execute('INSERT OR REPLACE INTO environments (name, id, filename, data) '
+                      'VALUES (?, ?, ?, ?)',
+                      (name, value.get('id'), value.get('filename'), json.dumps(value)))
+
+    def __delitem__(self, name):
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM provisioned WHERE stack_id IN '
+                                 '(SELECT id FROM environments WHERE name = ?)', (name,))
+                cursor = self._db.execute('DELETE FROM environments WHERE name = ?', (name,))
+        if not cursor.rowcount:
+            raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [row[0] for row in self._execute('SELECT name FROM environments ORDER BY name')]
+
+    def values(self):
+        return [json.loads(row[0]) for row in
+                self._execute('SELECT data FROM environments ORDER BY name')]
+
+    def find(self, id=None, filename=None):
+        """Returns the environments with the given stack id or filename."""
+        if id is not None:
+            rows = self._execute('SELECT data FROM environments WHERE id = ?', (id,))
+        else:
+            rows = self._execute('SELECT data FROM environments WHERE filename = ?', (filename,))
+        return [json.loads(row[0]) for row in rows]
+
+    def provisioned(self, stack_id):
+        """Returns the completed provisioner runs of a stack.
+
+        :returns: dictionary mapping (instance, provisioner) to the ID of
+                  the server and the hash of the provisioner at the time
+                  it succeeded
+        """
+        rows = self._execute('SELECT instance, provisioner, server, hash FROM provisioned '
+                             'WHERE stack_id = ?', (stack_id,))
+        return dict(((instance, provisioner), (server, hash))
+                    for (instance, provisioner, server, hash) in rows)
+
+    def set_provisioned(self, stack_id, instance, provisioner, server, hash):
+        self._execute('INSERT OR REPLACE INTO provisioned '
+                      '(stack_id, instance, provisioner, server, hash, time) VALUES (?, ?, ?, ?, ?, ?)',
+                      (stack_id, instance, provisioner, server, hash, time.time()))
+
+    def unset_provisioned(self, stack_id, instance, provisioner):
+        self._execute('DELETE FROM provisioned WHERE stack_id = ? AND instance = ? AND provisioner = ?',
+                      (stack_id, instance, provisioner))
+
+    def migrate_shelve(self, filename):
+        """Imports the environments of a shelve file once.
+
+        Check, import and marker are one immediate transaction, so only
+        one of several processes starting at the same time imports.
+        """
+
+        if not glob.glob(filename + '*'):
+            return
+        if self._execute("SELECT 1 FROM meta WHERE key = 'migrated_shelve'"):
+            return
+
+        with self._immediate():
+            if not self._db.execute("SELECT 1 FROM meta WHERE key = 'migrated_shelve'").fetchall():
+                self._import_shelve(filename)
+
+    def _import_shelve(self, filename):
+        # called within the transaction of migrate_shelve
+        self.log.info("migrating environments from shelve file %s" % filename)
+        data = shelve.open(filename, 'r')
+        try:
+            rows = [(name, value.get('id'), value.get('filename'), json.dumps(value))
+                    for name, value in data.items() if value]
+        finally:
+            data.close()
+        self._db.executemany('INSERT OR IGNORE INTO environments '
+                             '(name, id, filename, data) VALUES (?, ?, ?, ?)', rows)
+        self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('migrated_shelve', ?)",
+                         (filename,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
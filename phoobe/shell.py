@@ -12,33 +12,37 @@
 
 import logging
 import os
-import shelve
 import sys
+import time
 import warnings
-import yaml
 
 import appdirs
 from cliff import app
 from cliff import command
 from cliff import commandmanager
-from heatclient.client import Client
-from openstack import connection
-from openstack.auth import service_filter
-import os_client_config
 
+from phoobe import cache
 from phoobe import environment
+from phoobe import registry
+from phoobe import tracing
 from phoobe import utils
 
+# services whose endpoints are stored with a cached token
+_cached_services = ('orchestration', 'compute')
+
 # based on https://github.com/openstack/python-openstackclient/blob/master/openstackclient/shell.py
 
 class PhoobeShell(app.App):
 
     connection = None
     environment = None
+    ssh_pool = None
+    _command_start = None
 
     log = logging.getLogger(__name__)
 
     def __init__(self):
+        self.data_dir = appdirs.user_data_dir('phoobe')
         super(PhoobeShell, self).__init__(
             description='phoobe',
             version='0.1',
@@ -100,18 +104,51 @@ class PhoobeShell(app.App):
             #default=utils.env('PHOOBE_ENVIRONMENT_NAME'),
             help='Environment name (Env: PHOOBE_ENVIRONMENT_NAME)',
         )
+        parser.add_argument(
+            '--lookup-cache-ttl',
+            metavar='<seconds>',
+            dest='lookup_cache_ttl',
+            default=0,
+            type=int,
+            help='Persist resolved cloud resources for the given seconds',
+        )
+        parser.add_argument(
+            '--profile',
+            dest='profile',
+            default=False,
+            action='store_true',
+            help='Print the time spent in config loading, auth, API calls, templates and SSH',
+        )
+        parser.add_argument(
+            '--profile-output',
+            metavar='<file>',
+            dest='profile_output',
+            default=None,
+            help='Write the recorded spans as Chrome trace (implies --profile)',
+        )
         return parser
 
     def initialize_app(self, argv):
         self.log.debug('initialize_app')
-        shelve_file = os.path.join(appdirs.user_data_dir('phoobe'), 'phoobe.shelve')
-        self.log.debug("initializing shelve file %s" % shelve_file)
-        if not os.path.exists(appdirs.user_data_dir('phoobe')):
-            os.makedirs(appdirs.user_data_dir('phoobe'))
-        self.cache = shelve.open(os.path.join(appdirs.user_data_dir('phoobe'), 'phoobe.shelve'))
+        if self.options.profile or self.options.profile_output:
+            tracing.enable()
+        with tracing.span('config'):
+            self._load_configuration()
+
+    def _load_configuration(self):
+        registry_file = os.path.join(self.data_dir, 'phoobe.sqlite')
+        self.log.debug("initializing registry file %s" % registry_file)
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+        self.cache = registry.Registry(registry_file)
+        self.cache.migrate_shelve(os.path.join(self.data_dir, 'phoobe.shelve'))
+        self.token_cache = cache.TokenCache(os.path.join(self.data_dir, 'tokens.json'))
+        self.template_cache = cache.TemplateCache(os.path.join(self.data_dir, 'templates'))
+        self.snapshot_dir = os.path.join(self.data_dir, 'environments')
 
         if os.path.exists(self.options.configuration_file):
-            configuration = yaml.load(open(self.options.configuration_file))
+            with open(self.options.configuration_file) as fp:
+                configuration = utils.load_yaml(fp)
             if 'cloud_config_name' in configuration:
                 self.options.cloud_config_name = configuration['cloud_config_name']
 
@@ -124,28 +161,102 @@ class PhoobeShell(app.App):
             if 'use_softwareconfig' in configuration:
                 self.options.use_software_config = configuration['use_softwareconfig']
 
+            if 'lookup_cache_ttl' in configuration:
+                self.options.lookup_cache_ttl = configuration['lookup_cache_ttl']
+
+        self.lookup_cache = cache.LookupCache(
+            os.path.join(self.data_dir, 'lookups.json'),
+            self.options.lookup_cache_ttl, self.options.cloud_config_name)
+
     def prepare_to_run_command(self, cmd):
         self.log.debug('prepare_to_run_command %s', cmd.__class__.__name__)
 
+        self._command_start = time.time()
+
         if cmd.connection_required or cmd.connection_heat_required:
-            osc = os_client_config.OpenStackConfig()
-            self.cloud = osc.get_one_cloud(self.options.cloud_config_name, argparse=self.options)
-            self.connection = connection.Connection(**self.cloud.config['auth'])
+            with tracing.span('auth connect'):
+                self.connection = self.connect()
 
         if cmd.environment_required:
-            self.environment = environment.Environment(self.options.environment_file, self.options.environment_name)
+            with tracing.span('environment load'):
+                self.environment = environment.Environment(self.options.environment_file, self.options.environment_name,
+                                                           snapshot_dir=self.snapshot_dir)
 
         if cmd.connection_heat_required:
-            token = self.connection.session.authenticator.auth_plugin.authorize(self.connection.transport)
-            heat_service = service_filter.ServiceFilter('orchestration', version='v1')
-            self.connection_heat = Client('1', endpoint=token.service_catalog.get_url(heat_service), token=token.auth_token)
+            with tracing.span('auth orchestration'):
+                self.connection_heat = self.connect_heat()
 
+    # the clients are imported only for commands using them, this keeps
+    # the startup of e.g. --help or template short
+
+    def connect(self):
+        from openstack import connection
+        import os_client_config
+
+        osc = os_client_config.OpenStackConfig()
+        self.cloud = osc.get_one_cloud(self.options.cloud_config_name, argparse=self.options)
+        return connection.Connection(**self.cloud.config['auth'])
+
+    def authorize(self):
+        """Returns the token and the endpoints, from the token cache if possible."""
+        auth = self.cloud.config['auth']
+        cached = self.token_cache.get(self.options.cloud_config_name, auth)
+        if cached and all(service in cached['endpoints'] for service in _cached_services):
+            self.log.debug('using cached token for %s' % ', '.join(_cached_services))
+            return cached['token'], cached['endpoints']
+
+        from openstack.auth import service_filter
+
+        access = self.connection.session.authenticator.auth_plugin.authorize(self.connection.transport)
+        endpoints = {
+            'orchestration': access.service_catalog.get_url(
+                service_filter.ServiceFilter('orchestration', version='v1')),
+            'compute': access.service_catalog.get_url(
+                service_filter.ServiceFilter('compute')),
+        }
+        self.token_cache.set(self.options.cloud_config_name, auth, access.auth_token,
+                             endpoints, access.expires)
+        return access.auth_token, endpoints
+
+    def connect_heat(self):
+        token, endpoints = self.authorize()
+        return self.heat_client(endpoints['orchestration'], token)
+
+    def connect_compute(self):
+        """Returns a client listing servers without authenticating again."""
+        token, endpoints = self.authorize()
+        return self.compute_client(endpoints['compute'], token)
+
+    def heat_client(self, endpoint, token):
+        from heatclient.client import Client
+        return Client('1', endpoint=endpoint, token=token)
+
+    def compute_client(self, endpoint, token):
+        from phoobe import compute
+        return compute.ComputeClient(endpoint, token)
 
     def clean_up(self, cmd, result, err):
         self.log.debug('clean_up %s', cmd.__class__.__name__)
         self.cache.close()
+        if self.ssh_pool:
+            self.ssh_pool.close()
+        if cmd.connection_heat_required and _is_unauthorized(err):
+            # the cached token was revoked, next run authenticates again
+            self.token_cache.invalidate(self.options.cloud_config_name)
         if err:
             self.log.debug('got an error: %s', err)
+        if tracing.enabled() and self._command_start:
+            tracing.record('command %s' % cmd.__class__.__name__, self._command_start, time.time())
+            self.stderr.write(tracing.format_summary() + '\n')
+            if self.options.profile_output:
+                tracing.write_chrome_trace(self.options.profile_output)
+                self.stderr.write('trace written to %s\n' % self.options.profile_output)
+
+
+def _is_unauthorized(err):
+    from heatclient import exc
+    from phoobe import compute
+    return isinstance(err, (exc.HTTPUnauthorized, compute.UnauthorizedException))
 
 
 def main(argv=sys.argv[1:]):
@@ -0,0 +1,204 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import random
+import select
+import socket
+import threading
+import time
+
+from phoobe import tracing
+
+
+class InstanceNotReadyException(Exception):
+    pass
+
+
+_max_line = 65536
+
+
+def _split_lines(buffered, max_line):
+    """Returns the complete lines of buffered and the rest.
+
+    Lines longer than max_line bytes are split.
+    """
+
+    lines = []
+    while True:
+        end = buffered.find(b'\n')
+        if end == -1 and len(buffered) < max_line:
+            break
+        end = max_line - 1 if end == -1 else min(end, max_line - 1)
+        lines.append(buffered[:end + 1])
+        buffered = buffered[end + 1:]
+    return lines, buffered
+
+
+def _read_lines(channel, max_line, chunk_size=32768, poll_interval=1.0):
+    """Yields (stream, line) of the output of a channel while it is received.
+
+    stdout and stderr are read as they arrive, so a command writing much
+    to one of them does not block on the other.
+    """
+
+    receive = {'stdout': channel.recv, 'stderr': channel.recv_stderr}
+    ready = {'stdout': channel.recv_ready, 'stderr': channel.recv_stderr_ready}
+    buffered = {'stdout': b'', 'stderr': b''}
+    while True:
+        received = False
+        for stream in ('stdout', 'stderr'):
+            if ready[stream]():
+                chunk = receive[stream](chunk_size)
+                received = received or bool(chunk)
+                lines, buffered[stream] = _split_lines(buffered[stream] + chunk, max_line)
+                for line in lines:
+                    yield stream, line
+        if received:
+            continue
+        # the exit status arrives after all output of the command
+        if channel.exit_status_ready() or channel.closed:
+            if not (channel.recv_ready() or channel.recv_stderr_ready()):
+                break
+            continue
+        select.select([channel], [], [], poll_interval)
+    for stream in ('stdout', 'stderr'):
+        if buffered[stream]:
+            yield stream, buffered[stream]
+
+
+class ConnectionPool(object):
+    """Keeps one SSH session per (address, username) for reuse.
+
+    Commands are executed on new channels of the pooled sessions, so
+    every instance only pays for one TCP connection and key exchange.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, private_key, timeout=None):
+        self._private_key = private_key
+        self._timeout = timeout
+        self._connections = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _get_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, address, username):
+        key = (address, username)
+        with self._get_lock(key):
+            ssh = self._connections.get(key)
+            transport = ssh.get_transport() if ssh else None
+            if transport is None or not transport.is_active():
+                import paramiko
+                start = time.time()
+                self.log.debug("opening SSH session to %s@%s" % (username, address))
+                ssh = paramiko.SSHClient()
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                ssh.connect(address, username=username, pkey=self._private_key,
+                            timeout=self._timeout, look_for_keys=False,
+                            allow_agent=False)
+                tracing.record('ssh connect', start, time.time(), 'ssh', address=address)
+                self._connections[key] = ssh
+            return ssh
+
+    def discard(self, address, username):
+        with self._get_lock((address, username)):
+            ssh = self._connections.pop((address, username), None)
+        if ssh:
+            ssh.close()
+
+    def execute(self, address, username, command, stdin=None, callback=None,
+                max_line=_max_line):
+        """Runs command on a new channel and returns its exit status.
+
+        The output is read in chunks and passed on line by line as soon as
+        it arrives, lines longer than max_line bytes are split.
+
+        :param stdin: optional file object sent to the command
+        :param callback: called with every line of output and its stream,
+                         'stdout' or 'stderr'
+        """
+
+        with tracing.span('ssh execute', 'ssh', address=address, command=command[:64]) as args:
+            transport = self.get(address, username).get_transport()
+            channel = transport.open_session()
+            try:
+                channel.exec_command(command)
+                if stdin is not None:
+                    for chunk in iter(lambda: stdin.read(32768), ''):
+                        channel.sendall(chunk)
+                channel.shutdown_write()
+                for stream, line in _read_lines(channel, max_line):
+                    if callback:
+                        callback(line, stream)
+                args['status'] = channel.recv_exit_status()
+                return args['status']
+            finally:
+                channel.close()
+
+    def put(self, address, username, local_path, remote_path):
+        """Copies a file to the instance over SFTP on the pooled session."""
+
+        with tracing.span('ssh put', 'ssh', address=address, path=remote_path):
+            sftp = self.get(address, username).open_sftp()
+            try:
+                sftp.put(local_path, remote_path)
+            finally:
+                sftp.close()
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for ssh in connections:
+            ssh.close()
+
+
+def wait_until_ready(pool, address, username, deadline, timeout=10, port=22,
+                     initial_delay=1.0, max_delay=30.0):
+    """Waits until an instance accepts SSH and executes commands.
+
+    First the TCP port is probed, then `hostname` is executed on a
+    pooled session. Failed attempts are retried with jittered exponential
+    backoff until the absolute deadline (a time.time() value) is reached.
+
+    :param timeout: timeout of a single connection attempt
+    :returns: seconds until the instance was ready
+    """
+
+    import paramiko
+
+    log = logging.getLogger(__name__)
+    start = time.time()
+    delay = initial_delay
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            sock = socket.create_connection((address, port), timeout)
+            sock.close()
+            if pool.execute(address, username, 'hostname') == 0:
+                tracing.record('ssh wait', start, time.time(), 'ssh', address=address, attempts=attempt)
+                return time.time() - start
+        except (socket.error, paramiko.SSHException, EOFError) as e:
+            log.debug("attempt %d for %s@%s failed: %s" % (attempt, username, address, e))
+            pool.discard(address, username)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise InstanceNotReadyException(address)
+        time.sleep(min(remaining, delay / 2 + random.uniform(0, delay / 2)))
+        delay = min(max_delay, delay * 2)
@@ -1,9 +1,10 @@
+import json
 import os
-from pdb import set_trace as bp
 import yaml
-import pyaml
 
-from openstack.orchestration.v1 import stack
+from phoobe import cache
+from phoobe import tracing
+from phoobe import utils
 
 _skeleton_template = '''
 heat_template_version: '2013-05-23'
@@ -13,6 +14,40 @@ resources:
 outputs:
 '''
 
+# increase whenever the generated templates change
+_cache_version = 7
+
+# use the LibYAML based dumper if available
+_Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+class _TemplateDumper(_Dumper):
+
+    def ignore_aliases(self, data):
+        # shared references must not turn into anchors and aliases
+        return True
+
+def _represent_str(dumper, data):
+    # keep embedded scripts readable
+    if '\n' in data:
+        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
+
+for _type in set([str, type(u'')]):
+    _TemplateDumper.add_representer(_type, _represent_str)
+
+
+def get_resource(name):
+    return {'get_resource': name}
+
+def get_attr(name, attribute, *path):
+    return {'get_attr': [name, attribute] + list(path)}
+
+def get_param(name):
+    return {'get_param': name}
+
+def str_replace(template, params):
+    return {'str_replace': {'template': template, 'params': params}}
+
 class ExternalNetworkNotFoundException(Exception):
     pass
 
@@ -21,36 +56,52 @@ class ProvisionerNotDefinedException(Exception):
 
 class Resource(object):
 
-    def __init__(self, name, type, properties=None):
+    def __init__(self, name, type, properties=None, depends_on=None):
         self._name = name
         self._type = type
         self._properties = properties or {}
+        self._depends_on = depends_on or []
 
     def add_property(self):
         self._properties
 
     @property
     def data(self):
-        return {
-            self._name: {
-                'type': self._type,
-                'properties': self._properties
-            }
+        data = {
+            'type': self._type,
+            'properties': self._properties
         }
+        if self._depends_on:
+            data['depends_on'] = self._depends_on
+        return {self._name: data}
 
 
 class Template(object):
 
-    def __init__(self, environment, connection=None, standalone=True, use_softwareconfig=False):
+    def __init__(self, environment, connection=None, standalone=True, use_softwareconfig=False, lookup_cache=None, template_cache=None, output_format='yaml', nested=False):
         self._environment = environment
+        self._output_format = output_format
+        self._nested = nested
+        self._references = {}
+        self._router_interfaces = []
         self._connection = connection
+        self._lookup_cache = lookup_cache or cache.LookupCache()
+        self._template_cache = template_cache
         self._standalone = standalone
         self._use_softwareconfig = use_softwareconfig
-        self._template = yaml.load(_skeleton_template)
-        self._template['resources'] = {}
-        self._template['parameters'] = {}
-        self._template['outputs'] = {}
-        self._initialize()
+        self._template = None
+        self._children = {}
+        self._content = None
+        self._files = None
+        self._fingerprint = None
+
+    def _build(self):
+        with tracing.span('template build'):
+            self._template = utils.load_yaml(_skeleton_template)
+            self._template['resources'] = {}
+            self._template['parameters'] = {}
+            self._template['outputs'] = {}
+            self._initialize()
 
     def _add_parameter(self, name, type, description):
         self._template['parameters'][name] = {
@@ -58,17 +109,61 @@ class Template(object):
             'description': description
         }
 
-    def _add_output(self, name, value, description):
-        self._template['outputs'][name] = {
+    def _add_output(self, name, value, description, template=None):
+        (template or self._template)['outputs'][name] = {
             'value': value, 
             'description': description
         }
 
-    def _add_resource(self, resource):
-        self._template['resources'].update(resource.data)
+    def _add_resource(self, resource, template=None):
+        (template or self._template)['resources'].update(resource.data)
+
+    def _find_network_id(self, name):
+        def find():
+            network = self._connection.network.find_network(name)
+            return network['id'] if network else None
+        network_id = self._lookup_cache.get('network', name, find)
+        if not network_id:
+            raise ExternalNetworkNotFoundException(name)
+        return network_id
+
+    def _read_provisioner(self, provisioner):
+        script_path = os.path.join(os.path.dirname(self._environment.filename), provisioner['path'])
+        with open(script_path) as fp:
+            return fp.read()
+
+    @property
+    def fingerprint(self):
+        """Hash of everything the generated template depends on."""
+
+        if self._fingerprint is None:
+            with open(self._environment.filename) as fp:
+                environment_data = fp.read()
+            scripts = dict((name, self._read_provisioner(provisioner))
+                           for name, provisioner in self._environment.provisioners.items()
+                           if 'path' in provisioner)
+            external_networks = {}
+            if self._standalone:
+                names = set(network.get('external') for network in self._environment.networks.values())
+                names.update(instance.get('external') for instance in self._environment.instances.values())
+                external_networks = dict((name, self._find_network_id(name)) for name in names if name)
+            self._fingerprint = cache.fingerprint({
+                'version': _cache_version,
+                'name': self._environment.name,
+                'environment': environment_data,
+                'scripts': scripts,
+                'standalone': self._standalone,
+                'use_softwareconfig': self._use_softwareconfig,
+                'output_format': self._output_format,
+                'nested': self._nested,
+                'external_networks': external_networks,
+            })
+        return self._fingerprint
 
     @property
     def dictionary(self):
+        if self._template is None:
+            self._build()
         return self._template
 
     def _initialize(self):
@@ -83,7 +178,7 @@ class Template(object):
         }
         keypair = Resource(keypair_name, 'OS::Nova::KeyPair', keypair_properties)
         self._add_resource(keypair)
-        self._add_output('private_ssh_key', '{ get_attr: [ %s, private_key ] }' % keypair_name, 'Private SSH key')
+        self._add_output('private_ssh_key', get_attr(keypair_name, 'private_key'), 'Private SSH key')
 
         # security groups
         security_group_name = 'security_group'
@@ -106,46 +201,64 @@ class Template(object):
 
         for network_name in self._environment.networks:
             data = self._environment.networks[network_name]
+            if self._nested:
+                network_template = self._new_template()
+                target = network_template
+                router_reference = get_param('router')
+            else:
+                target = self._template
+                router_reference = get_resource(router_name)
+
             net_name = 'net_' + network_name
             net_properties = {
                 'name': '%s_%s' % (environment_name, network_name)
             }
             net = Resource(net_name, 'OS::Neutron::Net', net_properties)
-            self._add_resource(net)
+            self._add_resource(net, target)
 
             subnet_name = 'subnet_' + network_name
-            # check if this is a valid CIDR
             subnet_properties = {
                 'name': '%s_%s' % (environment_name, subnet_name),
                 'cidr': data['cidr'],
-                'network_id': '{ get_resource: %s }' % net_name
+                'network_id': get_resource(net_name)
             }
             subnet = Resource(subnet_name, 'OS::Neutron::Subnet', subnet_properties)
-            self._add_resource(subnet)
+            self._add_resource(subnet, target)
 
             if data.get('external', None) or data.get('router', False):
                 # NOTE: at the moment only one external network is possible
                 external_network = data['external']
                 router_interface_name = 'router_interface_' + subnet_name
                 router_interface_properties = {
-                    'router_id': '{ get_resource: %s }' % router_name,
-                    'subnet_id': '{ get_resource: %s }' % subnet_name
+                    'router_id': router_reference,
+                    'subnet_id': get_resource(subnet_name)
                 }
                 router_interface = Resource(router_interface_name, 'OS::Neutron::RouterInterface', router_interface_properties)
-                self._add_resource(router_interface)
+                self._add_resource(router_interface, target)
+                if not self._nested:
+                    self._router_interfaces.append(router_interface_name)
+
+            if self._nested:
+                # one nested stack per network with its subnet and router interface
+                stack_name = 'network_' + network_name
+                parameters = {}
+                if network_template['resources'].get('router_interface_' + subnet_name):
+                    network_template['parameters']['router'] = {'type': 'string'}
+                    parameters['router'] = get_resource(router_name)
+                    self._router_interfaces.append(stack_name)
+                for name in (net_name, subnet_name):
+                    self._add_output(name, get_resource(name), name, network_template)
+                    self._references[name] = (stack_name, name)
+                self._add_resource(self._nested_stack(stack_name, network_template, parameters))
 
         router_properties = {
             'name': '%s_%s' % (environment_name, router_name)
         }
         if external_network:
             if self._standalone:
-                external_network_id = self._connection.network.find_network(external_network)
-                if not external_network_id:
-                    raise ExternalNetworkNotFoundException(external_network)
-                else:
-                    router_properties['external_gateway_info'] = {'network': external_network_id['id']}
+                router_properties['external_gateway_info'] = {'network': self._find_network_id(external_network)}
             else:
-                router_properties['external_gateway_info'] = {'network': '{ get_param: external_network }'}
+                router_properties['external_gateway_info'] = {'network': get_param('external_network')}
 
         router = Resource(router_name, 'OS::Neutron::Router', router_properties)
         self._add_resource(router)
@@ -156,9 +269,7 @@ class Template(object):
             if provisioner['type'] == 'shell' and self._use_softwareconfig:
                 config = ''
                 if 'path' in provisioner:
-                    script_path = os.path.join(os.path.dirname(self._environment.filename), provisioner['path'])
-                    with open(script_path) as fp:
-                        config = fp.read()
+                    config = self._read_provisioner(provisioner)
                 software_config_name = 'software_config_' + provisioner_name
                 software_config_properties = {
 #                    'name': '%s_%s' % (environment_name, software_config_name),
@@ -171,103 +282,269 @@ class Template(object):
         # instances
         for instance_name in self._environment.instances:
             data = self._environment.instances[instance_name]
-            instance_properties = {
-                'name': '%s_%s' % (environment_name, instance_name),
-                'flavor': data['flavor'],
-                'key_name': '{ get_resource: keypair }',
-                'networks': []
+            if 'group' in data:
+                continue
+            if self._nested:
+                external_network = self._add_nested_instance(instance_name, data, external_network)
+            else:
+                external_network = self._add_instance(
+                    self._template, instance_name, data, external_network,
+                    lambda name, value=None: self._reference(name) if value is None else value)
+
+        # instance groups
+        for group_name in self._environment.groups:
+            data = self._environment.groups[group_name]
+            external_network = self._add_instance_group(group_name, data, external_network)
+
+    def _local_name(self, prefix, instance_name, grouped):
+        # every member of a group lives in its own nested stack
+        return prefix if grouped else '%s_%s' % (prefix, instance_name)
+
+    def _add_instance(self, template, instance_name, data, external_network, ref, grouped=False, index=None):
+        """Adds the server, ports, volume and floating IP of an instance.
+
+        :param template: template dictionary the resources are added to
+        :param ref: returns the reference to a resource (or value) outside
+                    of the instance
+        :param index: reference to the index of a group member, replaces
+                      %index% in the names
+        :returns: the external network used for floating IPs
+        """
+
+        def physical_name(name):
+            # Heat replaces %index% only in the properties of the
+            # resource_def, not in the template of the members
+            if index is None:
+                return name
+            return str_replace(name, {'%index%': index})
+
+        environment_name = self._environment.name
+        server_name = 'server' if grouped else instance_name
+        instance_properties = {
+            'name': physical_name('%s_%s' % (environment_name, instance_name)),
+            'flavor': data['flavor'],
+            'key_name': ref('keypair'),
+            'networks': []
+        }
+
+        if data.get('volume'):
+            volume_name = self._local_name('volume', instance_name, grouped)
+            volume_properties = {
+                'name': physical_name('%s_volume_%s' % (environment_name, instance_name)),
+                'image': data['image'],
+                'size': data['volume']
+            }
+            volume = Resource(volume_name, 'OS::Cinder::Volume', volume_properties)
+            self._add_resource(volume, template)
+            block_device_mapping = [{
+                'device_name': 'vda',
+                'delete_on_termination': True,
+                'volume_id': get_resource(volume_name)
+            }]
+            instance_properties['block_device_mapping'] = block_device_mapping
+        else:
+            instance_properties['image'] = data['image']
+
+        for network in data.get('networks') or [data['network']]:
+            if isinstance(network, str):
+                network_name = network
+                address = None
+            elif isinstance(network, dict):
+                network_name = network.iterkeys().next()
+                address = network[network_name]
+            port_name = self._local_name('port', instance_name, grouped) + '_' + network_name
+            port_properties = {
+                'name': physical_name('%s_port_%s_%s' % (environment_name, instance_name, network_name)),
+                'network_id': ref('net_' + network_name),
+                'security_groups': ['default', ref('security_group')]
             }
 
-            if data.get('volume'):
-                volume_name = 'volume_' + instance_name
-                volume_properties = {
-                    'name': '%s_%s' % (environment_name, volume_name),
-                    'image': data['image'],
-                    'size': data['volume']
-                }
-                volume = Resource(volume_name, 'OS::Cinder::Volume', volume_properties)
-                self._add_resource(volume)
-                block_device_mapping = [{
-                    'device_name': 'vda',
-                    'delete_on_termination': True,
-                    'volume_id': '{ get_resource: %s }' % volume_name
-                }]
-                instance_properties['block_device_mapping'] = block_device_mapping
+            fixed_ips = {
+                'subnet_id': ref('subnet_' + network_name)
+            }
+            if address:
+                fixed_ips['ip_address'] = address
+
+            port_properties['fixed_ips'] = [fixed_ips]
+            port = Resource(port_name, 'OS::Neutron::Port', port_properties)
+            self._add_resource(port, template)
+            instance_properties['networks'].append({'port': get_resource(port_name)})
+
+        if not external_network and data.get('external', False):
+            external_network = data.get('external')
+
+        if external_network:
+            floatingip_name = self._local_name('floatingip', instance_name, grouped)
+            floatingip_properties = {
+                'port_id': get_resource(self._local_name('port', instance_name, grouped) + '_' + data['network'])
+            }
+            if self._standalone:
+                floating_network_id = self._find_network_id(external_network)
             else:
-                instance_properties['image'] = data['image']
-
-            for network in data.get('networks', [data['network']]):
-                if isinstance(network, str):
-                    network_name = network
-                    address = None
-                elif isinstance(network, dict):
-                    network_name = network.iterkeys().next()
-                    address = network[network_name]
-                port_name = 'port_' + instance_name + '_' + network_name
-                port_properties = {
-                    'name': '%s_%s' % (environment_name, port_name),
-                    'network_id': '{ get_resource: net_%s }' % network_name,
-                    'security_groups': ['default', '{ get_resource: security_group }']
+                self._add_parameter('external_network', 'string', 'UUID of the external network')
+                floating_network_id = get_param('external_network')
+            floatingip_properties['floating_network_id'] = ref('floating_network_id', floating_network_id)
+            floatingip = Resource(floatingip_name, 'OS::Neutron::FloatingIP', floatingip_properties)
+            self._add_resource(floatingip, template)
+            self._add_output(
+                floatingip_name,
+                get_attr(floatingip_name, 'floating_ip_address'),
+                'Floating IP address of instance %s' % instance_name,
+                template
+            )
+
+        # provisoners
+        for provisioner_name in data.get('provisioners', []):
+            if not provisioner_name in self._environment.provisioners:
+                raise(ProvisionerNotDefinedException(provisioner_name))
+            provisioner = self._environment.provisioners[provisioner_name]
+            if provisioner['type'] == 'shell' and self._use_softwareconfig:
+                software_deployment_name = self._local_name('software_deployment_' + provisioner_name, instance_name, grouped)
+                software_deployment_properties = {
+#                    'name': '%s_%s' % (environment_name, software_deployment_name),
+                    'config': ref('software_config_' + provisioner_name),
+                    'server': get_resource(server_name)
                 }
+                software_deployment = Resource(software_deployment_name, 'OS::Heat::SoftwareDeployment', software_deployment_properties)
+                self._add_resource(software_deployment, template)
+                instance_properties['user_data_format'] = 'SOFTWARE_CONFIG'
 
-                fixed_ips = {
-                    'subnet_id': '{ get_resource: subnet_%s }' % network_name
-                }
-                if address:
-                    # check if this is a valid ip address for this subnet
-                    fixed_ips['ip_address'] = address
-
-                port_properties['fixed_ips'] = [fixed_ips]
-                port = Resource(port_name, 'OS::Neutron::Port', port_properties)
-                self._add_resource(port)
-                instance_properties['networks'].append({'port': '{ get_resource: %s }' % port_name})
-
-            if not external_network and data.get('external', False):
-                external_network = data.get('external')
-
-            if external_network:
-                floatingip_name = 'floatingip_' + instance_name
-                floatingip_properties = {
-                    'port_id': '{ get_resource: port_%s_%s}' % (instance_name, data['network'])
-                }
-                if self._standalone:
-                    external_network_id = self._connection.network.find_network(external_network)
-                    if not external_network_id:
-                        raise ExternalNetworkNotFoundException(external_network)
-                    else:
-                        floatingip_properties['floating_network_id'] = external_network_id['id']
-                else:
-                    self._add_parameter('external_network', 'string', 'UUID of the external network')
-                    floatingip_properties['floating_network_id'] = '{ get_param: external_network }'
-                floatingip = Resource(floatingip_name, 'OS::Neutron::FloatingIP', floatingip_properties)
-                self._add_resource(floatingip)
-                self._add_output(
-                    'floatingip_' + instance_name,
-                    '{ get_attr: [ %s, floating_ip_address ] }' % floatingip_name,
-                    'Floating IP address of instance %s' % instance_name
-                )
-
-            # provisoners
-            for provisioner_name in data.get('provisioners', []):
-                if not provisioner_name in self._environment.provisioners:
-                    raise(ProvisionerNotDefinedException(provisioner_name))
-                provisioner = self._environment.provisioners[provisioner_name]
-                if provisioner['type'] == 'shell' and self._use_softwareconfig:
-                    software_deployment_name = 'software_deployment_%s_%s' % (provisioner_name, instance_name)
-                    software_deployment_properties = {
-#                        'name': '%s_%s' % (environment_name, software_deployment_name),
-                        'config': '{ get_resource: software_config_%s }' % provisioner_name,
-                        'server': '{ get_resource: %s }' % instance_name
-                    }
-                    software_deployment = Resource(software_deployment_name, 'OS::Heat::SoftwareDeployment', software_deployment_properties)
-                    self._add_resource(software_deployment)
-                    instance_properties['user_data_format'] = 'SOFTWARE_CONFIG'
-
-            instance = Resource(instance_name, 'OS::Nova::Server', instance_properties)
-            self._add_resource(instance)
+        instance = Resource(server_name, 'OS::Nova::Server', instance_properties)
+        self._add_resource(instance, template)
+        return external_network
+
+    def _new_template(self):
+        return {
+            'heat_template_version': '2013-05-23',
+            'parameters': {},
+            'resources': {},
+            'outputs': {},
+        }
+
+    def _provider_template(self, name, template):
+        """Registers the template of a nested stack, returns its file name.
+
+        The file name is used as resource type, Heat creates the nested
+        stack from the template passed in the files of the stack.
+        """
+
+        filename = '%s.yaml' % name
+        self._children[filename] = template
+        return filename
+
+    def _nested_stack(self, name, template, parameters):
+        return Resource(name, self._provider_template(name, template), parameters)
+
+    def _reference(self, name):
+        # resources moved into nested stacks are referenced by their outputs
+        if name in self._references:
+            return get_attr(*self._references[name])
+        return get_resource(name)
+
+    def _add_nested_member(self, instance_name, data, external_network, indexed=False):
+        """Builds the template of an instance living in its own stack.
+
+        Resources outside of the instance are passed in as parameters,
+        members of a group get their index as parameter as well.
+
+        :returns: the template, its parameters and the external network
+        """
+
+        member = self._new_template()
+        parameters = {}
+        index = None
+        if indexed:
+            member['parameters']['index'] = {'type': 'string'}
+            parameters['index'] = '%index%'
+            index = get_param('index')
+
+        def ref(name, value=None):
+            member['parameters'][name] = {'type': 'string'}
+            parameters[name] = self._reference(name) if value is None else value
+            return get_param(name)
+
+        external_network = self._add_instance(member, instance_name, data,
+                                              external_network, ref, grouped=True, index=index)
+        return member, parameters, external_network
+
+    def _add_nested_instance(self, instance_name, data, external_network):
+        member, parameters, external_network = self._add_nested_member(instance_name, data, external_network)
+        self._add_resource(self._nested_stack(instance_name, member, parameters))
+        if member['outputs']:
+            self._add_output('floatingip_' + instance_name,
+                             get_attr(instance_name, 'floatingip'),
+                             'Floating IP address of instance %s' % instance_name)
+        return external_network
+
+    def _add_instance_group(self, group_name, data, external_network):
+        """Adds a ResourceGroup with count members of an instance.
+
+        Every member is a nested stack with its own server, ports, volume
+        and floating IP. Members are named <group>_<index>.
+        """
+
+        member, parameters, external_network = self._add_nested_member(
+            '%s_%%index%%' % group_name, data, external_network, indexed=True)
+        group_properties = {
+            'count': data['count'],
+            'resource_def': {
+                'type': self._provider_template(group_name, member),
+                'properties': parameters,
+            }
+        }
+        # the implicit dependency of floating IPs on the router interfaces
+        # only works inside of a stack, the members need it explicitly
+        depends_on = None
+        if member['outputs']:
+            depends_on = ['router'] + sorted(self._router_interfaces)
+        group = Resource(group_name, 'OS::Heat::ResourceGroup', group_properties, depends_on)
+        self._add_resource(group)
+        if member['outputs']:
+            self._add_output('floatingips_' + group_name, get_attr(group_name, 'floatingip'),
+                             'Floating IP addresses of instance group %s' % group_name)
+        return external_network
+
+    def _serialize(self, dictionary, output_format):
+        if output_format == 'json':
+            return json.dumps(dictionary, indent=2, sort_keys=True)
+        return yaml.dump(dictionary, Dumper=_TemplateDumper,
+                         default_flow_style=False)
+
+    def dump(self, output_format='yaml'):
+        """Serializes the template in a single pass as YAML or JSON."""
+        dictionary = self.dictionary
+        with tracing.span('template serialize', format=output_format):
+            return self._serialize(dictionary, output_format)
+
+    def dump_files(self, output_format='yaml'):
+        """Serializes the templates of the nested stacks.
+
+        :returns: dictionary mapping file names (the resource types) to
+                  the templates
+        """
+        self.dictionary
+        with tracing.span('template serialize files', format=output_format):
+            return dict((filename, self._serialize(child, output_format))
+                        for filename, child in self._children.items())
+
+    def _load(self):
+        if self._content is None and self._template_cache:
+            cached = self._template_cache.get(self.fingerprint)
+            if cached is not None:
+                self._content, self._files = cached
+        if self._content is None:
+            self._content = self.dump(self._output_format)
+            self._files = self.dump_files(self._output_format)
+            if self._template_cache:
+                self._template_cache.set(self.fingerprint, self._content, self._files)
 
     @property
     def content(self):
-        result = pyaml.dump(self._template)
-        result = result.replace("'{", "{").replace("}'", "}")
-        return result
+        self._load()
+        return self._content
+
+    @property
+    def files(self):
+        """Templates of the nested stacks, passed to Heat with the template."""
+        self._load()
+        return self._files
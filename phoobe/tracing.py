@@ -0,0 +1,169 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Records timing spans of a phoobe run (--profile).
+
+Spans are only recorded after enable() was called, otherwise span() does
+nothing. The HTTP requests of the OpenStack clients are recorded by
+wrapping requests.Session.request.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+_lock = threading.Lock()
+_spans = None
+_origin = None
+
+
+class Span(object):
+
+    __slots__ = ('name', 'category', 'start', 'end', 'thread', 'args')
+
+    def __init__(self, name, category, start, end, thread, args):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = end
+        self.thread = thread
+        self.args = args
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+def enable():
+    global _spans, _origin
+    with _lock:
+        if _spans is None:
+            _spans = []
+            _origin = time.time()
+    _instrument_requests()
+
+
+def enabled():
+    return _spans is not None
+
+
+def record(name, start, end, category='phoobe', **args):
+    """Records a span which already finished."""
+    if _spans is None:
+        return
+    span = Span(name, category, start, end, threading.current_thread().name, args)
+    with _lock:
+        _spans.append(span)
+
+
+@contextlib.contextmanager
+def span(name, category='phoobe', **args):
+    """Records the time spent in the with block."""
+    if _spans is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    except Exception as e:
+        args['error'] = e.__class__.__name__
+        raise
+    finally:
+        record(name, start, time.time(), category, **args)
+
+
+def spans():
+    with _lock:
+        return list(_spans or [])
+
+
+def summary():
+    """Returns rows of (name, count, total, mean, max) seconds, slowest first."""
+    groups = {}
+    for s in spans():
+        groups.setdefault(s.name, []).append(s.duration)
+    rows = [(name, len(durations), sum(durations), sum(durations) / len(durations), max(durations))
+            for name, durations in groups.items()]
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def format_summary():
+    lines = ['%-48s %6s %10s %10s %10s' % ('span', 'count', 'total ms', 'mean ms', 'max ms')]
+    for name, count, total, mean, maximum in summary():
+        lines.append('%-48s %6d %10.1f %10.1f %10.1f'
+                     % (name[:48], count, total * 1000, mean * 1000, maximum * 1000))
+    return '\n'.join(lines)
+
+
+def chrome_trace():
+    """Returns the spans in the Chrome trace event format."""
+    threads = {}
+    events = []
+    for s in spans():
+        tid = threads.setdefault(s.thread, len(threads) + 1)
+        events.append({
+            'name': s.name,
+            'cat': s.category,
+            'ph': 'X',
+            'ts': int((s.start - _origin) * 1e6),
+            'dur': int(s.duration * 1e6),
+            'pid': os.getpid(),
+            'tid': tid,
+            'args': dict((key, str(value)) for key, value in s.args.items()),
+        })
+    for name, tid in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                       'args': {'name': name}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(filename):
+    with open(filename, 'w') as fp:
+        json.dump(chrome_trace(), fp)
+
+
+_instrumented = False
+
+
+def _instrument_requests():
+    """Records every HTTP request of the OpenStack clients."""
+
+    global _instrumented
+    with _lock:
+        if _instrumented:
+            return
+        _instrumented = True
+    try:
+        import requests
+    except ImportError:
+        return
+    original = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.time()
+        status = None
+        try:
+            response = original(self, method, url, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            record('api %s %s' % (method.upper(), urlparse(url).netloc), start, time.time(),
+                   'api', method=method.upper(), url=url, status=status)
+
+    requests.Session.request = request
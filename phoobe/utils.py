@@ -11,6 +11,15 @@
 # under the License.
 
 import os
+import yaml
+
+# the LibYAML loader is considerably faster, if PyYAML was built with it
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_yaml(stream):
+    """Parses a YAML document (string or file) with the safe loader."""
+    return yaml.load(stream, Loader=_Loader)
 
 # source: https://github.com/openstack/oslo-incubator/blob/master/openstack/common/cliutils.py
 
@@ -25,11 +34,22 @@ def env(*args, **kwargs):
     return kwargs.get('default', '')
 
 
-def get_item_properties(item, fields, connection=None, filters={}):
+def get_subnet_index(connection, **query):
+    """Return a dictionary mapping subnet IDs to their CIDR.
+
+    All subnets are fetched with a single listing.
+    """
+
+    return dict((subnet.id, subnet.cidr)
+                for subnet in connection.network.subnets(**query))
+
+
+def get_item_properties(item, fields, subnet_index=None, filters={}):
     """Return a tuple containing the item properties.
 
     :param item: a single item resource (e.g. Server, Project, etc)
     :param fields: tuple of strings with the desired field names
+    :param subnet_index: dictionary mapping subnet IDs to CIDRs
     :param filters: dictionary with fields to filter
     """
 
@@ -44,10 +64,9 @@ def get_item_properties(item, fields, connection=None, filters={}):
     for field in fields:
         name = field.lower().replace(' ', '_')
 
-        if name == 'subnets' and connection:
-            subnets = []
-            for subnet in getattr(item, name, ''):
-                subnets.append(connection.network.get_subnet(subnet).cidr)
+        if name == 'subnets' and subnet_index is not None:
+            subnets = [subnet_index.get(subnet, subnet)
+                       for subnet in getattr(item, name, '')]
             data = str.join(", ", subnets)
         else:
             data = getattr(item, name, '')
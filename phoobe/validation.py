@@ -0,0 +1,155 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+
+from phoobe import environment as env
+from phoobe import executor
+from phoobe import tracing
+
+
+class ValidationFailedException(Exception):
+    pass
+
+
+class Catalog(object):
+    """Flavors, images and external networks of a cloud.
+
+    Everything is fetched with one listing per type (concurrently) and
+    indexed by name and ID.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, connection):
+        with tracing.span('validate catalog'):
+            flavors, images, networks = executor.Executor(3).gather(
+                lambda: list(connection.compute.flavors()),
+                lambda: list(connection.compute.images()),
+                lambda: list(connection.network.networks(**{'router:external': True})))
+        self.flavors = self._index(flavors)
+        self.images = self._index(images)
+        self.external_networks = self._index(networks)
+        self.log.debug("fetched %d flavors, %d images and %d external networks"
+                       % (len(flavors), len(images), len(networks)))
+
+    def _index(self, items):
+        index = {}
+        for item in items:
+            index[item.id] = item
+            index[item.name] = item
+        return index
+
+
+def _instance_networks(instance):
+    """Returns (network name, fixed address or None) of an instance."""
+    result = []
+    for network in instance.get('networks', [instance.get('network')]):
+        if isinstance(network, dict):
+            for name, address in network.items():
+                result.append((name, address))
+        else:
+            result.append((network, None))
+    return result
+
+
+def validate(environment, catalog=None):
+    """Checks an environment and returns a list of error messages.
+
+    Without a catalog only the checks not requiring the cloud are done.
+    """
+
+    import netaddr
+
+    errors = []
+
+    # networks
+    cidrs = {}
+    for network_name in sorted(environment.networks):
+        data = environment.networks[network_name]
+        try:
+            cidrs[network_name] = netaddr.IPNetwork(data['cidr'])
+        except (netaddr.AddrFormatError, TypeError, ValueError):
+            errors.append("network '%s': invalid CIDR '%s'" % (network_name, data['cidr']))
+        if catalog and data.get('external') and not data['external'] in catalog.external_networks:
+            errors.append("network '%s': external network '%s' not found" % (network_name, data['external']))
+
+    names = sorted(cidrs)
+    for i, first in enumerate(names):
+        for second in names[i + 1:]:
+            if cidrs[first] in cidrs[second] or cidrs[second] in cidrs[first]:
+                errors.append("network '%s': CIDR %s overlaps with network '%s' (%s)"
+                              % (first, cidrs[first], second, cidrs[second]))
+
+    # instances, groups are checked once
+    instances = dict((name, data) for name, data in environment.instances.items()
+                     if not 'group' in data)
+    instances.update(environment.groups)
+    for instance_name in sorted(instances):
+        data = instances[instance_name]
+        prefix = "instance '%s'" % instance_name
+        if catalog and not data.get('flavor') in catalog.flavors:
+            errors.append("%s: flavor '%s' not found" % (prefix, data.get('flavor')))
+        if catalog and not data.get('image') in catalog.images:
+            errors.append("%s: image '%s' not found" % (prefix, data.get('image')))
+        if catalog and data.get('external') and not data['external'] in catalog.external_networks:
+            errors.append("%s: external network '%s' not found" % (prefix, data['external']))
+        for network_name, address in _instance_networks(data):
+            if not network_name in environment.networks:
+                errors.append("%s: network '%s' not defined" % (prefix, network_name))
+            elif address and 'count' in data:
+                errors.append("%s: fixed address %s not possible for an instance group"
+                              % (prefix, address))
+            elif address and network_name in cidrs:
+                try:
+                    if not netaddr.IPAddress(address) in cidrs[network_name]:
+                        errors.append("%s: address %s not in network '%s' (%s)"
+                                      % (prefix, address, network_name, cidrs[network_name]))
+                except (netaddr.AddrFormatError, ValueError):
+                    errors.append("%s: invalid address '%s'" % (prefix, address))
+        for provisioner_name in data.get('provisioners', []):
+            if not provisioner_name in environment.provisioners:
+                errors.append("%s: provisioner '%s' not defined" % (prefix, provisioner_name))
+
+    # provisioners
+    environment_path = os.path.dirname(environment.filename)
+    for provisioner_name in sorted(environment.provisioners):
+        provisioner = environment.provisioners[provisioner_name]
+        if provisioner.get('type') == 'shell' and 'path' in provisioner:
+            if not os.path.isfile(os.path.join(environment_path, provisioner['path'])):
+                errors.append("provisioner '%s': script '%s' not found"
+                              % (provisioner_name, provisioner['path']))
+        if 'directory' in provisioner:
+            if not os.path.isdir(os.path.join(environment_path, provisioner['directory'])):
+                errors.append("provisioner '%s': directory '%s' not found"
+                              % (provisioner_name, provisioner['directory']))
+        # also for provisioners not assigned to any instance, the graph
+        # only contains assigned ones
+        dependencies = provisioner.get('depends_on', [])
+        if not isinstance(dependencies, list):
+            dependencies = [dependencies]
+        for dependency in dependencies:
+            if not (dependency in environment.provisioners or dependency in environment.instances
+                    or dependency in environment.groups):
+                errors.append("provisioner '%s': unknown dependency '%s'" % (provisioner_name, dependency))
+
+    # the dependency graph is only built on demand
+    try:
+        environment.provisioning_graph
+    except env.UnknownDependencyException:
+        # already reported above
+        pass
+    except env.DependencyCycleException as e:
+        errors.append("dependency cycle %s" % e)
+
+    return errors
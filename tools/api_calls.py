@@ -0,0 +1,116 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Counts the API calls of phoobe commands against a fake cloud.
+
+Runs the life cycle of an environment (validate, up, status, resources,
+update, destroy) against phoobe.fakes.FakeCloud and reports the API calls
+and the time of every command. Fails if a command makes more calls than
+its budget.
+
+    $ python tools/api_calls.py --latency 0.05
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from phoobe import fakes  # noqa
+
+_environment = '''
+defaults:
+  instance:
+    image: cirros
+    flavor: m1.small
+networks:
+  frontend:
+    cidr: 10.0.1.0/24
+    external: public
+  backend:
+    cidr: 10.0.2.0/24
+instances:
+  web:
+    network: frontend
+  database:
+    network: frontend
+    networks: [frontend, backend]
+    volume: 10
+  worker:
+    network: backend
+    count: 2
+'''
+
+# command and the maximum number of API calls. Every command using the SDK
+# connection (Neutron, flavors and images) authenticates against Keystone,
+# Heat and the servers of status use the cached token. destroy --wait reads
+# the newest event before deleting, so old events are not shown.
+COMMANDS = [
+    (['validate'], 4),
+    (['up', '--wait'], 7),
+    (['status'], 3),
+    (['resources'], 1),
+    (['update'], 2),
+    (['destroy', '--wait'], 3),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Counts the API calls of phoobe commands')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='Seconds added to every API call')
+    args = parser.parse_args()
+
+    # stacks complete at once, so waiting costs a single poll
+    cloud = fakes.FakeCloud(latency=args.latency)
+    directory = tempfile.mkdtemp(prefix='phoobe-api-calls-')
+    cwd = os.getcwd()
+    failed = False
+    try:
+        os.chdir(directory)
+        with open('environment.yaml', 'w') as fp:
+            fp.write(_environment)
+        devnull = open(os.devnull, 'w')
+
+        print('%-16s %6s %8s %10s  %s' % ('command', 'calls', 'budget', 'time (ms)', 'calls by API'))
+        for command, budget in COMMANDS:
+            cloud.reset_calls()
+            argv = ['--environment-file', 'environment.yaml', '--environment-name', 'budget'] + command
+            start = time.time()
+            result = fakes.run(cloud, argv, os.path.join(directory, 'data'), stdout=devnull)
+            duration = time.time() - start
+            calls = dict(cloud.calls)
+            total = sum(calls.values())
+            print('%-16s %6d %8d %10.1f  %s' % (
+                ' '.join(command), total, budget, duration * 1000,
+                ', '.join('%s=%d' % item for item in sorted(calls.items()))))
+            if result != 0:
+                print('ERROR: %s failed with %s' % (' '.join(command), result))
+                failed = True
+            elif total > budget:
+                print('ERROR: %s made %d calls, budget is %d' % (' '.join(command), total, budget))
+                failed = True
+        devnull.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
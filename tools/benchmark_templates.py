@@ -0,0 +1,215 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks loading environments and generating templates.
+
+Synthetic environments with the given numbers of instances (plus networks,
+volumes and provisioners scaled with them) are generated in a temporary
+directory. For every size the following stages are measured:
+
+* environment: environment.Environment()
+* snapshot: environment.Environment() from an up-to-date snapshot
+* template: Template(standalone=False).content
+* standalone: Template(standalone=True).content with a fake connection
+* nested: Template(nested=True).content (with --nested)
+
+Time and peak memory (tracemalloc, Python 3 only) are reported per stage.
+Results can be stored and compared with a former run:
+
+    $ python tools/benchmark_templates.py --output before.json
+    $ python tools/benchmark_templates.py --compare before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from phoobe import environment  # noqa
+from phoobe import fakes  # noqa
+from phoobe import template  # noqa
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def synthesize(directory, instances, networks=None, provisioners=5):
+    """Writes an environment file with the given number of instances.
+
+    One network per 50 instances, every second instance has a volume and
+    every instance uses one or two of the provisioners.
+    """
+
+    networks = networks or max(1, instances // 50)
+    data = {
+        'defaults': {
+            'instance': {'image': 'cirros', 'flavor': 'm1.small'},
+        },
+        'networks': {},
+        'instances': {},
+        'provisioners': {},
+    }
+    for index in range(networks):
+        data['networks']['network%d' % index] = {
+            'cidr': '10.%d.%d.0/24' % (index // 256, index % 256),
+            'external': 'public',
+        }
+    for index in range(provisioners):
+        path = 'provisioner%d.sh' % index
+        with open(os.path.join(directory, path), 'w') as fp:
+            fp.write('#!/bin/bash\nset -e\necho provisioner %d\n' % index)
+        data['provisioners']['provisioner%d' % index] = {'type': 'shell', 'path': path}
+    for index in range(instances):
+        instance = {
+            'network': 'network%d' % (index % networks),
+            'provisioners': ['provisioner%d' % (index % provisioners)],
+        }
+        if index % 2:
+            instance['volume'] = 10
+        if index % 3 == 0:
+            instance['provisioners'].append('provisioner%d' % ((index + 1) % provisioners))
+        data['instances']['instance%d' % index] = instance
+
+    filename = os.path.join(directory, 'environment-%d.yaml' % instances)
+    with open(filename, 'w') as fp:
+        yaml.safe_dump(data, fp, default_flow_style=False)
+    return filename
+
+
+def measure(func):
+    """Calls func and returns (result, seconds, peak bytes or None)."""
+
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    start = _timer()
+    try:
+        result = func()
+        duration = _timer() - start
+        peak = tracemalloc.get_traced_memory()[1] if tracemalloc else None
+    finally:
+        if tracemalloc:
+            tracemalloc.stop()
+    return result, duration, peak
+
+
+def run(sizes, repeat, nested):
+    stages = ['environment', 'snapshot', 'template', 'standalone']
+    if nested:
+        stages.append('nested')
+    results = {}
+    directory = tempfile.mkdtemp(prefix='phoobe-benchmark-')
+    try:
+        for size in sizes:
+            filename = synthesize(directory, size)
+            snapshot_dir = os.path.join(directory, 'snapshots-%d' % size)
+            env = environment.Environment(filename, 'benchmark', snapshot_dir=snapshot_dir)
+            connection = fakes.FakeCloud().connection
+            funcs = {
+                'environment': lambda: environment.Environment(filename, 'benchmark'),
+                'snapshot': lambda: environment.Environment(filename, 'benchmark', snapshot_dir=snapshot_dir),
+                'template': lambda: template.Template(env, standalone=False).content,
+                'standalone': lambda: template.Template(env, connection, standalone=True).content,
+                'nested': lambda: template.Template(env, connection, nested=True).content,
+            }
+            results[str(size)] = {}
+            for stage in stages:
+                # best time of all runs, the peak memory does not vary
+                runs = [measure(funcs[stage]) for i in range(repeat)]
+                results[str(size)][stage] = {
+                    'seconds': min(duration for (result, duration, peak) in runs),
+                    'peak_bytes': runs[0][2],
+                }
+                print('.', end='', file=sys.stderr)
+                sys.stderr.flush()
+    finally:
+        shutil.rmtree(directory)
+    print(file=sys.stderr)
+    return stages, results
+
+
+def report(stages, results, baseline=None):
+    print('%8s  %-12s %12s %14s %12s%s' % ('size', 'stage', 'time (ms)', 'per instance', 'peak (MiB)',
+                                          '  change' if baseline else ''))
+    regressions = []
+    for size in sorted(results, key=int):
+        for stage in stages:
+            entry = results[size][stage]
+            peak = entry['peak_bytes']
+            line = '%8s  %-12s %12.1f %11.1f us %12s' % (
+                size, stage, entry['seconds'] * 1000, entry['seconds'] * 1e6 / int(size),
+                '%.1f' % (peak / 1048576.0) if peak is not None else '-')
+            before = (baseline or {}).get(size, {}).get(stage)
+            if before:
+                ratio = entry['seconds'] / before['seconds']
+                line += '  %+6.1f%%' % ((ratio - 1) * 100)
+                regressions.append((size, stage, ratio))
+            print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks environment loading and template generation')
+    parser.add_argument('--sizes', default='10,100,1000,10000',
+                        help='Comma separated numbers of instances')
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='Runs per stage, the best time is reported')
+    parser.add_argument('--nested', default=False, action='store_true',
+                        help='Measure templates with nested stacks as well')
+    parser.add_argument('--output', default=None,
+                        help='Store the results in this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='Compare with the results of a former run')
+    parser.add_argument('--threshold', default=1.25, type=float,
+                        help='Fail if a stage is slower than the former run by this factor')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stages, results = run(sizes, args.repeat, args.nested)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+    regressions = report(stages, results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+
+    slower = [(size, stage, ratio) for (size, stage, ratio) in regressions if ratio > args.threshold]
+    for size, stage, ratio in slower:
+        print('ERROR: %s with %s instances is %.2f times slower' % (stage, size, ratio))
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measures the import time of the phoobe CLI.
+
+Imports the modules loaded by every phoobe command (the shell and the
+actions) in fresh interpreters, reports the best time and the slowest
+modules (cumulative time like ``python -X importtime``, which is not
+available on Python 2). Fails if one of the cloud or SSH clients is
+imported at startup or if the time exceeds --max-time.
+
+    $ python tools/importtime.py --repeat 10 --max-time 300
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+
+# only to be imported by commands needing them
+HEAVY_MODULES = [
+    'heatclient',
+    'netaddr',
+    'networkx',
+    'openstack',
+    'os_client_config',
+    'paramiko',
+]
+
+STARTUP_MODULES = ['phoobe.shell', 'phoobe.actions']
+
+_probe = '''
+import json, sys, time
+start = time.time()
+for module in %r:
+    __import__(module)
+duration = time.time() - start
+print(json.dumps({'duration': duration, 'modules': sorted(sys.modules)}))
+'''
+
+
+# times every import loading a new module, the hook itself slows the
+# imports down, so it runs in a separate interpreter
+_importtime_probe = '''
+import json, sys, time
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+_import = builtins.__import__
+cumulative = {}
+
+def timed_import(name, *args, **kwargs):
+    fromlist = args[2] if len(args) > 2 else kwargs.get('fromlist')
+    candidates = [name] + ['%%s.%%s' %% (name, item) for item in fromlist or ()
+                           if isinstance(item, str) and item != '*']
+    new = [candidate for candidate in candidates if sys.modules.get(candidate) is None]
+    if not new:
+        return _import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        loaded = [candidate for candidate in new if sys.modules.get(candidate) is not None]
+        if loaded:
+            cumulative[loaded[-1]] = int((time.time() - start) * 1e6)
+
+builtins.__import__ = timed_import
+for module in %r:
+    __import__(module)
+builtins.__import__ = _import
+print(json.dumps(cumulative))
+'''
+
+
+def measure(modules):
+    output = subprocess.check_output([sys.executable, '-c', _probe % modules])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def importtime(modules, top):
+    """Returns the slowest (cumulative microseconds, module) entries."""
+    output = subprocess.check_output([sys.executable, '-c', _importtime_probe % modules])
+    cumulative = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    entries = [(microseconds, module) for module, microseconds in cumulative.items()]
+    return sorted(entries, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the import time of the phoobe CLI')
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='Number of fresh interpreters, the best time is reported')
+    parser.add_argument('--top', default=15, type=int,
+                        help='Number of slowest modules to show')
+    parser.add_argument('--max-time', default=None, type=float,
+                        help='Fail if the best import time exceeds this (milliseconds)')
+    args = parser.parse_args()
+
+    results = [measure(STARTUP_MODULES) for i in range(args.repeat)]
+    best = min(result['duration'] for result in results) * 1000
+    loaded = set(results[0]['modules'])
+    print('import of %s: %.1f ms (best of %d), %d modules'
+          % (', '.join(STARTUP_MODULES), best, args.repeat, len(loaded)))
+
+    entries = importtime(STARTUP_MODULES, args.top)
+    if entries:
+        print('\n%12s  %s' % ('cumulative', 'module'))
+        for cumulative, module in entries:
+            print('%9.1f ms  %s' % (cumulative / 1000.0, module))
+
+    failed = False
+    heavy = sorted(module for module in HEAVY_MODULES if module in loaded)
+    if heavy:
+        print('\nERROR: imported at startup: %s' % ', '.join(heavy))
+        failed = True
+    if args.max_time is not None and best > args.max_time:
+        print('\nERROR: import time %.1f ms exceeds %.1f ms' % (best, args.max_time))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())